@@ -0,0 +1,308 @@
+import contextlib
+from datetime import datetime, timezone
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utilities import CardSize, PaperSize, generate_pdf, load_layouts
+
+try:
+    import resource
+except ImportError:
+    # resource is not available on Windows, so peak memory is not reported there
+    resource = None
+
+image_formats = {
+    'png': ('PNG', 'png'),
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp')
+}
+
+default_output_path = 'benchmark.json'
+
+def make_card_image(index: int, width: int, height: int, alpha: bool, rng: np.random.Generator) -> Image.Image:
+    """Synthesizes card art with gradients, noise, a frame and text, so it compresses like a real card"""
+    y, x = np.mgrid[0:height, 0:width]
+    hue = rng.uniform(0, 1, 3)
+    gradient = (np.sin(x[..., None] / width * 6 + hue * 6) + np.cos(y[..., None] / height * 4 + hue * 3)) * 60 + 128
+    noise = rng.normal(0, 12, (height, width, 3))
+    pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+
+    image = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(image)
+
+    border = max(1, width // 25)
+    draw.rounded_rectangle((0, 0, width - 1, height - 1), radius=border * 2, outline=(20, 20, 20), width=border)
+    draw.rectangle((border * 2, height // 2, width - border * 2, height - border * 3), fill=(235, 225, 200))
+    draw.text((border * 3, border * 3), f'Card {index}', fill=(0, 0, 0), font_size=max(10, height // 15))
+
+    if alpha:
+        # Rounded corners are transparent, like many card scans
+        mask = Image.new('L', image.size, 0)
+        ImageDraw.Draw(mask).rounded_rectangle((0, 0, width - 1, height - 1), radius=border * 2, fill=255)
+        image.putalpha(mask)
+
+    return image
+
+def save_card_image(image: Image.Image, path: str, image_format: str, exif: bool):
+    pil_format, _ = image_formats[image_format]
+
+    save_args = {}
+    if pil_format in ('JPEG', 'WEBP'):
+        save_args['quality'] = 90
+
+    if exif:
+        # Store the pixels rotated and let the EXIF orientation rotate them back
+        image = image.transpose(Image.Transpose.ROTATE_90)
+        image_exif = Image.Exif()
+        image_exif[0x0112] = 6
+        save_args['exif'] = image_exif
+
+    image.save(path, pil_format, **save_args)
+
+def make_deck(deck_path: str, deck_size: int, width: int, height: int, image_format: str, alpha: bool, exif: bool):
+    """Creates front, back and double-sided directories, where half of the deck is double-sided"""
+    rng = np.random.default_rng(deck_size)
+    _, extension = image_formats[image_format]
+
+    for directory in ['front', 'back', 'double_sided']:
+        os.makedirs(os.path.join(deck_path, directory), exist_ok=True)
+
+    for i in range(deck_size):
+        save_card_image(make_card_image(i, width, height, alpha, rng), os.path.join(deck_path, 'front', f'card{i}.{extension}'), image_format, exif)
+
+    save_card_image(make_card_image(-1, width, height, alpha, rng), os.path.join(deck_path, 'back', f'back.{extension}'), image_format, exif)
+
+    for i in range(math.ceil(deck_size / 2)):
+        save_card_image(make_card_image(deck_size + i, width, height, alpha, rng), os.path.join(deck_path, 'double_sided', f'card{i}.{extension}'), image_format, exif)
+
+def get_card_faces(deck_size: int, double_sided: bool) -> int:
+    """The number of card faces rendered for a deck, since double-sided cards also render the backs in the double-sided directory"""
+    return deck_size + (math.ceil(deck_size / 2) if double_sided else 0)
+
+def get_peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+def run_case(case: dict, deck_path: str, double_sided_dir_path: str, output_path: str, results: multiprocessing.Queue):
+    """Runs generate_pdf once in a fresh process, so peak memory belongs to this case only"""
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_pdf(
+                front_dir_path=os.path.join(deck_path, 'front'),
+                back_dir_path=os.path.join(deck_path, 'back'),
+                double_sided_dir_path=double_sided_dir_path,
+                output_path=output_path,
+                output_images=False,
+                card_size=case['card_size'],
+                paper_size=case['paper_size'],
+                registration='3',
+                only_fronts=False,
+                crop_string=case['crop'],
+                extend_corners=case['extend_corners'],
+                ppi=case['ppi'],
+                quality=75,
+                skip_indices=[],
+                load_offset=False,
+                offset_profile=None,
+                name=None,
+                jobs=case['jobs'],
+                native_pdf=case['native_pdf']
+            )
+        wall_time = time.perf_counter() - start
+
+        results.put({'wall_time': wall_time, 'peak_rss_mb': get_peak_rss_mb()})
+
+    except Exception as e:
+        results.put({'error': str(e)})
+
+def case_name(case: dict) -> str:
+    return ' '.join([
+        case['card_size'],
+        case['paper_size'],
+        f'{case["ppi"]}ppi',
+        case['image_format'],
+        'double-sided' if case['double_sided'] else 'single-sided',
+        f'crop={case["crop"]}',
+        f'extend_corners={case["extend_corners"]}'
+    ])
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results: list, previous_path: str):
+    with open(previous_path, 'r') as previous_file:
+        previous_results = {case_name(result['case']): result for result in json.load(previous_file)['results']}
+
+    print(f'\nCompared with {previous_path}:')
+    for result in results:
+        previous = previous_results.get(case_name(result['case']))
+        if previous is None or 'wall_time' not in previous or 'wall_time' not in result:
+            continue
+
+        time_ratio = result['wall_time'] / previous['wall_time']
+        size_ratio = result['output_size'] / previous['output_size'] if previous['output_size'] else math.nan
+        print(f'{case_name(result["case"])}: time x{time_ratio:.2f}, size x{size_ratio:.2f}')
+
+@click.command()
+@click.option("--deck_size", default=18, type=click.IntRange(min=1), show_default=True, help="Number of front images in each synthesized deck.")
+@click.option("--image_format", default=['png'], type=click.Choice(list(image_formats), case_sensitive=False), multiple=True, show_default=True, help="Format of the synthesized card images.")
+@click.option("--source_ppi", default=300, type=click.IntRange(min=30), show_default=True, help="Resolution of the synthesized card images.")
+@click.option("--alpha", default=False, is_flag=True, help="Synthesize RGBA card images with transparent corners.")
+@click.option("--exif", default=False, is_flag=True, help="Synthesize card images stored rotated with an EXIF orientation.")
+@click.option("--card_size", type=click.Choice([t.value for t in CardSize], case_sensitive=False), multiple=True, help="Card sizes to benchmark. Defaults to every card size.")
+@click.option("--paper_size", type=click.Choice([t.value for t in PaperSize], case_sensitive=False), multiple=True, help="Paper sizes to benchmark. Defaults to every paper size.")
+@click.option("--ppi", default=[300, 600], type=click.IntRange(min=1), multiple=True, show_default=True, help="Pixels per inch (PPI) to benchmark.")
+@click.option("--jobs", default=1, type=click.IntRange(min=1), show_default=True, help="Number of processes used to render sheets in parallel.")
+@click.option("--native_pdf", default=False, is_flag=True, help="Benchmark placing card images directly in the PDF.")
+@click.option("--repeat", default=1, type=click.IntRange(min=1), show_default=True, help="Number of runs of each combination. The fastest run is reported.")
+@click.option("--output_path", default=default_output_path, show_default=True, help="The path to the JSON file with the results.")
+@click.option("--compare", help="The path to the JSON file of a previous benchmark to compare with.")
+def cli(deck_size, image_format, source_ppi, alpha, exif, card_size, paper_size, ppi, jobs, native_pdf, repeat, output_path, compare):
+    if alpha and 'jpeg' in image_format:
+        raise click.UsageError('JPEG images cannot have an alpha channel. Remove "--alpha" or the "jpeg" image format.')
+
+    layouts = load_layouts()
+
+    card_sizes = list(card_size) or [t.value for t in CardSize]
+    paper_sizes = list(paper_size) or [t.value for t in PaperSize]
+
+    cases = []
+    for paper, card, case_ppi, case_format, double_sided, crop, extend_corners in itertools.product(
+        paper_sizes, card_sizes, ppi, image_format, [False, True], [None, '3mm'], [0, 10]
+    ):
+        if paper not in layouts.paper_layouts or card not in layouts.paper_layouts[paper].card_layouts:
+            continue
+
+        cases.append({
+            'card_size': card,
+            'paper_size': paper,
+            'ppi': case_ppi,
+            'image_format': case_format,
+            'double_sided': double_sided,
+            'crop': crop,
+            'extend_corners': extend_corners,
+            'jobs': jobs,
+            'native_pdf': native_pdf
+        })
+
+    if len(cases) == 0:
+        raise click.UsageError('No supported combination of card size and paper size was selected.')
+
+    # Every run starts from a fresh interpreter, like a real invocation of create_pdf.py
+    context = multiprocessing.get_context('spawn')
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        deck_paths = {}
+        empty_dir_path = os.path.join(temp_dir, 'empty')
+        os.makedirs(empty_dir_path)
+
+        for i, case in enumerate(cases):
+            # Decks only depend on the card size and image format, so they are shared by every combination
+            deck_key = (case['card_size'], case['image_format'])
+            if deck_key not in deck_paths:
+                card_layout_size = layouts.card_sizes[case['card_size']]
+                deck_paths[deck_key] = os.path.join(temp_dir, f'{case["card_size"]}_{case["image_format"]}')
+                make_deck(
+                    deck_paths[deck_key],
+                    deck_size,
+                    math.floor(card_layout_size.width * source_ppi / 300),
+                    math.floor(card_layout_size.height * source_ppi / 300),
+                    case['image_format'],
+                    alpha,
+                    exif
+                )
+
+            deck_path = deck_paths[deck_key]
+            double_sided_dir_path = os.path.join(deck_path, 'double_sided') if case['double_sided'] else empty_dir_path
+
+            runs = []
+            for run in range(repeat):
+                # A new output path each run, so no run reuses the output of a previous one
+                run_output_path = os.path.join(temp_dir, f'output_{i}_{run}.pdf')
+
+                queue = context.Queue()
+                process = context.Process(target=run_case, args=(case, deck_path, double_sided_dir_path, run_output_path, queue))
+                process.start()
+                run_result = queue.get()
+                process.join()
+
+                if 'error' not in run_result:
+                    run_result['output_size'] = os.path.getsize(run_output_path)
+                runs.append(run_result)
+
+                for path in [run_output_path, f'{run_output_path}.manifest.json']:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+            errors = [run_result['error'] for run_result in runs if 'error' in run_result]
+            if errors:
+                result = {'case': case, 'error': errors[0]}
+                print(f'[{i + 1}/{len(cases)}] {case_name(case)}: error: {errors[0]}')
+
+            else:
+                best_run = min(runs, key=lambda run_result: run_result['wall_time'])
+                card_faces = get_card_faces(deck_size, case['double_sided'])
+                result = {
+                    'case': case,
+                    'cards': deck_size,
+                    'card_faces': card_faces,
+                    'wall_time': best_run['wall_time'],
+                    'wall_times': [run_result['wall_time'] for run_result in runs],
+                    'per_face_time': best_run['wall_time'] / card_faces,
+                    'peak_rss_mb': best_run['peak_rss_mb'],
+                    'output_size': best_run['output_size']
+                }
+
+                peak_rss = 'n/a' if result['peak_rss_mb'] is None else f'{result["peak_rss_mb"]:.0f} MB'
+                print(f'[{i + 1}/{len(cases)}] {case_name(case)}: {result["wall_time"]:.2f}s, {result["per_face_time"] * 1000:.0f} ms/face, {peak_rss} peak, {result["output_size"] / (1024 * 1024):.1f} MB')
+
+            results.append(result)
+
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'commit': get_git_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'deck': {
+                'deck_size': deck_size,
+                'source_ppi': source_ppi,
+                'alpha': alpha,
+                'exif': exif
+            },
+            'results': results
+        }, output_file, indent=2)
+
+    print(f'Saved benchmark results: {output_path}')
+
+    if compare is not None:
+        compare_results(results, compare)
+
+if __name__ == '__main__':
+    cli()
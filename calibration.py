@@ -1,91 +1,203 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
 import math
 import os
+from typing import List
+
+import click
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
+import pypdfium2 as pdfium
 
-from utilities import PaperSize
+from utilities import PaperSize, hash_file
 
 # Specify directory locations
 asset_directory = 'assets'
-
-for paper_size in PaperSize:
-    base_filename = f'{paper_size.value}_blank.jpg'
-    base_path = os.path.join(asset_directory, base_filename)
+calibration_directory = 'calibration'
+font_path = os.path.join(asset_directory, 'arial.ttf')
+
+# Bump when the drawing of calibration sheets changes, so existing sheets are generated again
+calibration_version = 1
+
+# Calibration sheets record the key of their parameters in their keywords after this prefix
+calibration_keywords_prefix = 'calibration:'
+
+# The test grid in pixels at 300 PPI
+test_size = 25
+test_distance = 75
+
+def get_calibration_path(output_dir: str, paper_size: PaperSize, ppi: int) -> str:
+    suffix = '' if ppi == 300 else f'_{ppi}'
+    return os.path.join(output_dir, f'{paper_size.value}_calibration{suffix}.pdf')
+
+def get_calibration_params(paper_size: PaperSize, ppi: int) -> dict:
+    """Everything that affects a calibration sheet, so an existing sheet is only reused when all of it matches"""
+    return {
+        'version': calibration_version,
+        'paper_size': paper_size.value,
+        'ppi': ppi,
+        'base_hash': hash_file(os.path.join(asset_directory, f'{paper_size.value}_blank.jpg')),
+        'font_hash': hash_file(font_path)
+    }
+
+def get_calibration_key(params: dict) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def is_calibration_up_to_date(pdf_path: str, params: dict) -> bool:
+    """Compares the parameters recorded in the keywords of a sheet with the current parameters"""
+    if not os.path.exists(pdf_path):
+        return False
+
+    try:
+        pdf = pdfium.PdfDocument(pdf_path)
+    except pdfium.PdfiumError:
+        return False
+
+    try:
+        keywords = pdf.get_metadata_dict().get('Keywords', '')
+    finally:
+        pdf.close()
+
+    # Sheets without recorded parameters were not generated from the current parameters
+    return keywords == f'{calibration_keywords_prefix}{get_calibration_key(params)}'
+
+def get_grid_start(print_size: int, matrix_size: int) -> float:
+    """The position of the first square of the grid, which centers the middle square on the page"""
+    matrix_half_size = math.floor(matrix_size / 2)
+
+    if matrix_size % 2 > 0:
+        return math.floor(print_size / 2) - (matrix_half_size * test_distance) - ((matrix_half_size + .5) * test_size)
+
+    if matrix_size <= 0:
+        raise Exception(f'matrix_size must be greater than 0; received: {matrix_size}')
+
+    return math.floor(print_size / 2) - ((matrix_half_size - .5) * test_distance) - (matrix_half_size * test_size)
+
+def get_square_spans(starts: np.ndarray, size: float, length: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Marks the pixels covered by squares along one axis, and which square covers each pixel.
+    Like ImageDraw.rectangle, squares cover whole pixels from the start to the end, both included.
+    """
+    covered = np.zeros(length, dtype=bool)
+    indices = np.full(length, -1)
+    for index, start in enumerate(starts):
+        first = max(0, math.floor(start))
+        last = min(length - 1, math.floor(start + size))
+        covered[first:last + 1] = True
+        indices[first:last + 1] = index
+
+    return covered, indices
+
+def draw_test_grid(image: Image.Image, starts_x: np.ndarray, starts_y: np.ndarray, size: float, center: tuple[int, int]) -> Image.Image:
+    """
+    Draws every square of the grid in one pass over the page, since squares line up in rows and columns.
+    Squares in the center row and column are blue.
+    """
+    covered_x, indices_x = get_square_spans(starts_x, size, image.width)
+    covered_y, indices_y = get_square_spans(starts_y, size, image.height)
+
+    squares = covered_y[:, np.newaxis] & covered_x[np.newaxis, :]
+    centered = squares & ((indices_y == center[1])[:, np.newaxis] | (indices_x == center[0])[np.newaxis, :])
+
+    grid_image = image.copy()
+    grid_image.paste((0, 0, 0), mask=Image.fromarray(squares))
+    grid_image.paste((0, 0, 255), mask=Image.fromarray(centered))
+
+    return grid_image
+
+def draw_calibration_sheet(paper_size: PaperSize, ppi: int) -> tuple[Image.Image, Image.Image]:
+    """
+    Draws the front and back pages of a calibration sheet.
+    Each square of the back page is shifted by its coordinates in pixels at 300 PPI, which is the unit of offsets.
+    """
+    ppi_ratio = ppi / 300
 
     # Load a base page
-    with Image.open(base_path) as im:
-        font = ImageFont.truetype(os.path.join(asset_directory, 'arial.ttf'), 40)
-        coord_font = ImageFont.truetype(os.path.join(asset_directory, 'arial.ttf'), 25)
-        
+    with Image.open(os.path.join(asset_directory, f'{paper_size.value}_blank.jpg')) as im:
+        if im.height > im.width:
+            im = im.rotate(90, expand=True)
+
+        # The layout of the grid is computed at 300 PPI and scaled
         print_width = im.width
         print_height = im.height
-        
-        if print_height > print_width:
-            im = im.rotate(90, expand=True)
-            print_width = im.width
-            print_height = im.height
-            
-        front_image = im.copy()
-        front_draw = ImageDraw.Draw(front_image)
-        front_draw.text((print_width - 180, print_height - 180), 'front', fill=(0, 0, 0), anchor="ra", font=font)
-
-        back_image = im.copy()
-        back_draw = ImageDraw.Draw(back_image)
-        back_draw.text((print_width - 180, print_height - 180), 'back', fill=(0, 0, 0), anchor="ra", font=font)
-
-        test_size = 25
-        test_half_size = math.floor(test_size / 2)
-        test_distance = 75
-
-        matrix_size_x = math.floor(print_width / (test_size + test_distance)) - 6
-        matrix_half_size_x = math.floor(matrix_size_x / 2)
-        
-        matrix_size_y = math.floor(print_height / (test_size + test_distance)) - 6
-        matrix_half_size_y = math.floor(matrix_size_y / 2)
-
-
-        start_x = 0
-        if matrix_size_x % 2 > 0:
-            start_x = math.floor(print_width / 2) - (matrix_half_size_x * test_distance) - ((matrix_half_size_x + .5) * test_size)
-        else:
-            if matrix_size_x <= 0:
-                raise Exception(f'matrix_size must be greater than 0; received: {matrix_size_x}')
-            start_x = math.floor(print_width / 2) - ((matrix_half_size_x - .5) * test_distance) - (matrix_half_size_x * test_size)
-
-        start_y = 0
-        if matrix_size_y % 2 > 0:
-            start_y = math.floor(print_height / 2) - (matrix_half_size_y * test_distance) - ((matrix_half_size_y + .5) * test_size)
-        else:
-            if matrix_size_y <= 0:
-                raise Exception(f'matrix_size must be greater than 0; received: {matrix_size_y}')
-            start_y = math.floor(print_height / 2) - ((matrix_half_size_y - .5) * test_distance) - (matrix_half_size_y * test_size)
-
-
-        front_draw = ImageDraw.Draw(front_image)
-        back_draw = ImageDraw.Draw(back_image)
-
-        for x_index in range(matrix_size_x):
-            for y_index in range(matrix_size_y):
-                offset_x = x_index * (test_distance + test_size)
-                offset_y = y_index * (test_distance + test_size)
-
-                front_element_x = start_x + offset_x
-                front_element_y = start_y + offset_y
-                front_shape = [(front_element_x, front_element_y), (front_element_x + test_size, front_element_y + test_size)]
-                
-                fill="black"
-                if x_index == matrix_half_size_x or y_index == matrix_half_size_y:
-                    fill="blue"
-
-                front_draw.rectangle(front_shape, fill=fill)
-
-                back_element_x = front_element_x + x_index - matrix_half_size_x
-                back_element_y = front_element_y + y_index - matrix_half_size_y
-                back_shape = [(back_element_x, back_element_y), (back_element_x + test_size, back_element_y + test_size)]
-
-                back_draw.rectangle(back_shape, fill=fill)
-                
-                back_draw.text((back_element_x + test_half_size, back_element_y + test_half_size + 30), f'({x_index - matrix_half_size_x}, {y_index - matrix_half_size_y})', fill="red", anchor="mm", font=coord_font)
-
-        card_list = [front_image, back_image]
-        pdf_path = os.path.join("calibration", f"{paper_size.value}_calibration.pdf")
-        card_list[0].save(pdf_path, save_all=True, append_images=card_list[1:], resolution=300, speed=0, subsampling=0, quality=100)
\ No newline at end of file
+
+        base_image = im.convert('RGB')
+        if ppi != 300:
+            base_image = base_image.resize((math.floor(print_width * ppi_ratio), math.floor(print_height * ppi_ratio)), Image.Resampling.LANCZOS)
+
+    font = ImageFont.truetype(font_path, 40 * ppi_ratio)
+    coord_font = ImageFont.truetype(font_path, 25 * ppi_ratio)
+
+    matrix_size_x = math.floor(print_width / (test_size + test_distance)) - 6
+    matrix_half_size_x = math.floor(matrix_size_x / 2)
+
+    matrix_size_y = math.floor(print_height / (test_size + test_distance)) - 6
+    matrix_half_size_y = math.floor(matrix_size_y / 2)
+
+    offsets_x = np.arange(matrix_size_x) * (test_distance + test_size) + get_grid_start(print_width, matrix_size_x)
+    offsets_y = np.arange(matrix_size_y) * (test_distance + test_size) + get_grid_start(print_height, matrix_size_y)
+    coordinates_x = np.arange(matrix_size_x) - matrix_half_size_x
+    coordinates_y = np.arange(matrix_size_y) - matrix_half_size_y
+
+    center = (matrix_half_size_x, matrix_half_size_y)
+    front_image = draw_test_grid(base_image, offsets_x * ppi_ratio, offsets_y * ppi_ratio, test_size * ppi_ratio, center)
+
+    back_offsets_x = offsets_x + coordinates_x
+    back_offsets_y = offsets_y + coordinates_y
+    back_image = draw_test_grid(base_image, back_offsets_x * ppi_ratio, back_offsets_y * ppi_ratio, test_size * ppi_ratio, center)
+
+    label_position = ((print_width - 180) * ppi_ratio, (print_height - 180) * ppi_ratio)
+    ImageDraw.Draw(front_image).text(label_position, 'front', fill=(0, 0, 0), anchor="ra", font=font)
+
+    back_draw = ImageDraw.Draw(back_image)
+    back_draw.text(label_position, 'back', fill=(0, 0, 0), anchor="ra", font=font)
+
+    # Label every square of the back page with its offset
+    test_half_size = math.floor(test_size / 2)
+    for x_offset, coordinate_x in zip(back_offsets_x, coordinates_x):
+        for y_offset, coordinate_y in zip(back_offsets_y, coordinates_y):
+            text_position = ((x_offset + test_half_size) * ppi_ratio, (y_offset + test_half_size + 30) * ppi_ratio)
+            back_draw.text(text_position, f'({coordinate_x}, {coordinate_y})', fill="red", anchor="mm", font=coord_font)
+
+    return front_image, back_image
+
+def generate_calibration_sheet(paper_size: PaperSize, ppi: int, output_dir: str, force: bool = False) -> tuple[str, bool]:
+    """Saves the calibration sheet of a paper size unless it is up to date, and returns its path and whether it was saved"""
+    pdf_path = get_calibration_path(output_dir, paper_size, ppi)
+    params = get_calibration_params(paper_size, ppi)
+    if not force and is_calibration_up_to_date(pdf_path, params):
+        return pdf_path, False
+
+    front_image, back_image = draw_calibration_sheet(paper_size, ppi)
+    keywords = f'{calibration_keywords_prefix}{get_calibration_key(params)}'
+
+    # Write to a temporary file first, so an interrupted run never leaves a partial sheet
+    temp_path = f'{pdf_path}.tmp'
+    front_image.save(temp_path, format='PDF', save_all=True, append_images=[back_image], resolution=ppi, speed=0, subsampling=0, quality=100, keywords=keywords)
+    os.replace(temp_path, pdf_path)
+
+    return pdf_path, True
+
+@click.command()
+@click.option("--paper_size", type=click.Choice([t.value for t in PaperSize], case_sensitive=False), multiple=True, help="The paper size of a calibration sheet to generate. Repeat for several paper sizes. Every paper size by default.")
+@click.option("--ppi", default=300, type=click.IntRange(min=1), show_default=True, help="Pixels per inch (PPI) of the calibration sheets.")
+@click.option("--output_dir", default=calibration_directory, show_default=True, help="The directory where calibration sheets are saved.")
+@click.option("--jobs", default=1, type=click.IntRange(min=1), show_default=True, help="Number of processes used to generate calibration sheets for different paper sizes in parallel.")
+@click.option("--force", default=False, is_flag=True, help="Generate calibration sheets even if they are up to date.")
+
+def cli(paper_size: List[str], ppi: int, output_dir: str, jobs: int, force: bool):
+    paper_sizes = [PaperSize(size) for size in paper_size] or list(PaperSize)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if jobs <= 1 or len(paper_sizes) <= 1:
+        results = [generate_calibration_sheet(size, ppi, output_dir, force) for size in paper_sizes]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(generate_calibration_sheet, paper_sizes, [ppi] * len(paper_sizes), [output_dir] * len(paper_sizes), [force] * len(paper_sizes)))
+
+    for pdf_path, generated in results:
+        print(f'Generated calibration sheet: {pdf_path}' if generated else f'Calibration sheet is up to date: {pdf_path}')
+
+if __name__ == '__main__':
+    cli()
@@ -2,7 +2,7 @@ import os
 import re
 
 import click
-from utilities import Registration, CardSize, PaperSize, generate_pdf
+from utilities import Registration, CardSize, ImageFormat, PageCodec, PaperSize, ResampleQuality, Subsampling, generate_pdf, tracing
 
 front_directory = os.path.join('game', 'front')
 back_directory = os.path.join('game', 'back')
@@ -17,6 +17,8 @@ default_output_path = os.path.join(output_directory, 'game.pdf')
 @click.option("--double_sided_dir_path", default=double_sided_directory, show_default=True, help="The path to the directory containing card backs for double-sided cards.")
 @click.option("--output_path", default=default_output_path, show_default=True, help="The desired path to the output PDF.")
 @click.option("--output_images", default=False, is_flag=True, help="Create images instead of a PDF.")
+@click.option("--image_format", default=ImageFormat.PNG.value, type=click.Choice([t.value for t in ImageFormat], case_sensitive=False), show_default=True, help="The image format when creating images. TIFF images are compressed with LZW.")
+@click.option("--compress_level", default=6, type=click.IntRange(min=0, max=9), show_default=True, help="PNG compression when creating images. A lower value is faster and corresponds to a larger file size.")
 @click.option("--card_size", default=CardSize.STANDARD.value, type=click.Choice([t.value for t in CardSize], case_sensitive=False), show_default=True, help="The desired card size.")
 @click.option("--paper_size", default=PaperSize.LETTER.value, type=click.Choice([t.value for t in PaperSize], case_sensitive=False), show_default=True, help="The desired paper size.")
 @click.option("--registration", default=Registration.THREE.value, type=click.Choice([t.value for t in Registration], case_sensitive=False), show_default=True, help="The desired registration.")
@@ -25,10 +27,26 @@ default_output_path = os.path.join(output_directory, 'game.pdf')
 @click.option("--extend_corners", default=0, type=click.IntRange(min=0), show_default=True, help="Reduce artifacts produced by rounded corners in card images.")
 @click.option("--ppi", default=300, type=click.IntRange(min=0), show_default=True, help="Pixels per inch (PPI) when creating PDF.")
 @click.option("--quality", default=75, type=click.IntRange(min=0, max=100), show_default=True, help="File compression. A higher value corresponds to better quality and larger file size.")
+@click.option("--codec", default=PageCodec.JPEG.value, type=click.Choice([t.value for t in PageCodec], case_sensitive=False), show_default=True, help="Compression of PDF pages. 'flate' is lossless, 'auto' uses flate for pages with few colors and JPEG otherwise.")
+@click.option("--subsampling", default=Subsampling.S444.value, type=click.Choice([t.value for t in Subsampling]), show_default=True, help="JPEG chroma subsampling. '4:2:0' produces smaller files with slightly softer colors.")
+@click.option("--max_sheet_mb", type=click.FloatRange(min=0, min_open=True), help="Lower the quality and color detail of pages as needed to keep each sheet of the PDF under this many megabytes. Pages that cannot fit are kept at full quality and reported.")
 @click.option("--load_offset", default=False, is_flag=True, help="Apply saved offsets (legacy mode). See `offset_pdf.py` for more information.")
 @click.option("--offset_profile", help="Apply offsets from a named profile. Use 'default' to load the default profile.")
 @click.option("--skip", type=click.IntRange(min=0), multiple=True, help="Skip a card based on its index. Useful for registration issues. Examples: 0, 4.")
 @click.option("--name", help="Label each page of the PDF with a name.")
+@click.option("--jobs", default=1, type=click.IntRange(min=1), show_default=True, help="Number of processes used to render sheets and threads used to encode pages in parallel.")
+@click.option("--cache_dir", help="Directory for caching prepared card images and registration pages between runs.")
+@click.option("--cache_size", default=2048, type=click.IntRange(min=0), show_default=True, help="Maximum size of the card image cache in megabytes.")
+@click.option("--band_height", type=click.IntRange(min=16), help="Render and encode pages in horizontal bands of this many pixels, which bounds memory at a high PPI. Rounded down to a multiple of 16.")
+@click.option("--memory_mb", default=1024, type=click.IntRange(min=0), show_default=True, help="Maximum memory in megabytes for keeping prepared card images that are used more than once.")
+@click.option("--native_pdf", default=False, is_flag=True, help="Place card images directly in the PDF instead of rendering full-page images.")
+@click.option("--copies", default=1, type=click.IntRange(min=1), show_default=True, help="Number of copies of the deck to include in the output.")
+@click.option("--preview", default=False, is_flag=True, help="Quickly create a low-resolution PDF for checking the layout instead of printing. Saved next to the output PDF with a '.preview.pdf' extension.")
+@click.option("--preview_ppi", default=72, type=click.IntRange(min=1), show_default=True, help="Pixels per inch (PPI) of previews.")
+@click.option("--preview_path", help="Also create a low-resolution preview PDF at this path, from the same rendered pages.")
+@click.option("--resample_quality", default=ResampleQuality.HIGH.value, type=click.Choice([t.value for t in ResampleQuality], case_sensitive=False), show_default=True, help="Trade speed for sharpness when resizing card images. 'draft' and 'fast' are faster, 'best' is sharper.")
+@click.option("--plan", default=False, is_flag=True, help="Print the sheets that would be generated and check the card images without creating anything.")
+@click.option("--trace", help="Save a Chrome trace of where time is spent to this path and print a summary.")
 @click.version_option("1.5.1")
 
 def cli(
@@ -37,6 +55,8 @@ def cli(
     double_sided_dir_path,
     output_path,
     output_images,
+    image_format,
+    compress_level,
     card_size,
     paper_size,
     registration,
@@ -45,30 +65,64 @@ def cli(
     extend_corners,
     ppi,
     quality,
+    codec,
+    subsampling,
+    max_sheet_mb,
     skip,
     load_offset,
     offset_profile,
-    name
+    name,
+    jobs,
+    cache_dir,
+    cache_size,
+    band_height,
+    memory_mb,
+    native_pdf,
+    copies,
+    preview,
+    preview_ppi,
+    preview_path,
+    resample_quality,
+    plan,
+    trace
 ):
-    generate_pdf(
-        front_dir_path,
-        back_dir_path,
-        double_sided_dir_path,
-        output_path,
-        output_images,
-        card_size,
-        paper_size,
-        registration,
-        only_fronts,
-        crop,
-        extend_corners,
-        ppi,
-        quality,
-        skip,
-        load_offset,
-        offset_profile,
-        name
-    )
+    with tracing(trace):
+        generate_pdf(
+            front_dir_path,
+            back_dir_path,
+            double_sided_dir_path,
+            output_path,
+            output_images,
+            card_size,
+            paper_size,
+            registration,
+            only_fronts,
+            crop,
+            extend_corners,
+            ppi,
+            quality,
+            skip,
+            load_offset,
+            offset_profile,
+            name,
+            jobs,
+            cache_dir,
+            cache_size,
+            native_pdf,
+            copies,
+            preview,
+            preview_ppi,
+            preview_path,
+            resample_quality,
+            plan,
+            image_format,
+            compress_level,
+            codec,
+            subsampling,
+            max_sheet_mb,
+            memory_mb,
+            band_height
+        )
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
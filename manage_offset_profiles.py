@@ -21,11 +21,16 @@ Usage examples:
 
     # Show detailed info about a profile
     python manage_offset_profiles.py --info letter_hp
+
+    # Import profiles exported from another machine
+    python manage_offset_profiles.py --import profiles.json
 """
 
 import click
 import json
 from utilities import (
+    OffsetProfiles,
+    import_offset_profiles,
     load_offset_profiles,
     save_offset_profile,
     delete_offset_profile,
@@ -129,13 +134,18 @@ def manage_profiles(list_all, create, delete, info, set_default, x, y, paper, de
     if import_file:
         try:
             with open(import_file, 'r') as f:
-                data = json.load(f)
-            
-            # Import profiles (this would need additional implementation)
-            print(f"Import functionality would load profiles from {import_file}")
-            print("Note: Import functionality not yet implemented")
-        except Exception as e:
+                imported = OffsetProfiles(**json.load(f))
+        except (OSError, TypeError, ValueError) as e:
             print(f"Error importing profiles: {e}")
+            return
+
+        # All profiles are saved at once, so the profiles file is only read and written once
+        counts = import_offset_profiles(imported)
+        if counts is None:
+            return
+
+        num_added, num_replaced = counts
+        print(f"Imported {len(imported.profiles)} profiles from {import_file} ({num_added} added, {num_replaced} replaced)")
         return
     
     # If no specific action, show help
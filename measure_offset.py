@@ -0,0 +1,428 @@
+import math
+from typing import List
+
+import click
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image, ImageOps
+from pydantic import BaseModel
+
+from utilities import PaperSize, save_offset, save_offset_profile
+
+# The back squares of calibration sheets are this many pixels apart at 300 PPI, one more than the front squares
+back_square_spacing = 101
+
+# Estimates further than this many pixels at 300 PPI from the median are misdetections
+max_estimate_deviation = 3
+
+# A measurement is only saved when at least this fraction of the squares found agree, within this residual in pixels at 300 PPI
+min_agreeing_fraction = 0.5
+max_residual = 1.0
+
+# Shadows covered by their back square beyond this fraction are too small to place
+max_covered_shadow = 0.9
+
+# Squares are fitted in windows reaching this many pixels at 300 PPI past them and their shadows, beyond the blur of scans
+fit_margin = 12
+
+# Squares are fitted in batches of this many, over at most this many iterations until steps are below the tolerance,
+# with derivatives from steps of this many pixels
+fit_batch_size = 64
+fit_iterations = 30
+fit_tolerance = 0.01
+derivative_step = 0.01
+
+# The narrowest blur of the fitted squares in pixels, beyond the averaging of pixels
+min_blur = 0.05
+
+class OffsetMeasurement(BaseModel):
+    """An offset measured from a scan of a calibration sheet, in pixels at 300 PPI like saved offsets"""
+    x_offset: float
+    y_offset: float
+
+    # Rotation of the back page relative to the front page, which an offset cannot correct
+    skew_degrees: float
+
+    # Root mean square distance of the squares from the fitted offset and skew
+    residual: float
+    num_squares: int
+
+    # Squares found in the scan, including those whose estimates were left out
+    num_found: int
+
+    def get_problems(self) -> List[str]:
+        """Reasons the measurement cannot be trusted, if any"""
+        problems = []
+        if self.num_squares < min_agreeing_fraction * self.num_found:
+            problems.append(f'Only {self.num_squares} of the {self.num_found} squares found agree on the offset.')
+        if self.residual > max_residual:
+            problems.append(f'The squares are {self.residual:.2f} pixels from the fitted offset, more than {max_residual:.2f}.')
+
+        return problems
+
+def find_runs(profile: np.ndarray) -> List[tuple[int, int]]:
+    """The start and end, exclusive, of every run of True values"""
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], profile, [False])).astype(np.int8)))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+def find_square_runs(profile: np.ndarray, threshold: float) -> List[tuple[int, int]]:
+    """Runs of a projection above the threshold that are about as long as the typical run, which are squares"""
+    runs = find_runs(profile > threshold)
+    if not runs:
+        return []
+
+    typical_length = np.median([end - start for start, end in runs])
+    return [(start, end) for start, end in runs if 0.6 * typical_length <= end - start <= 1.4 * typical_length]
+
+def dilate(mask: np.ndarray, radius: int) -> np.ndarray:
+    """Marks every pixel within a square of the radius around a marked pixel"""
+    rows = sliding_window_view(np.pad(mask, radius), 2 * radius + 1, axis=0).any(axis=-1)
+    return sliding_window_view(rows, 2 * radius + 1, axis=1).any(axis=-1)
+
+def normal_cdf(x: np.ndarray) -> np.ndarray:
+    """The standard normal cumulative distribution, from an approximation of the error function accurate to 1.5e-7"""
+    z = np.abs(x) / math.sqrt(2)
+    t = 1 / (1 + 0.3275911 * z)
+    erf = 1 - t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429)))) * np.exp(-z * z)
+    return 0.5 + 0.5 * np.sign(x) * erf
+
+def integrated_normal_cdf(x: np.ndarray, blur: np.ndarray) -> np.ndarray:
+    """The integral up to x of the normal cumulative distribution with the blur as its standard deviation"""
+    return x * normal_cdf(x / blur) + blur * np.exp(-0.5 * (x / blur) ** 2) / math.sqrt(2 * math.pi)
+
+def blurred_boxes(positions: np.ndarray, starts: np.ndarray, ends: np.ndarray, blur: np.ndarray) -> np.ndarray:
+    """Profiles of boxes from the starts to the ends blurred by a Gaussian, averaged over the pixels at the positions, one box per row"""
+    blur = blur[:, None]
+    def integrate_edges(edges: np.ndarray) -> np.ndarray:
+        offsets = edges[:, None] - positions
+        return integrated_normal_cdf(offsets + 0.5, blur) - integrated_normal_cdf(offsets - 0.5, blur)
+
+    return integrate_edges(ends) - integrate_edges(starts)
+
+def render_square_models(parameters: np.ndarray, size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Darkness of back squares and the parts of their shadows that they leave uncovered, blurred, in square windows of the size.
+    Each row of parameters is the center, width and height of a square, the shift of its shadow, the blur,
+    and the darkness of the square, the shadow and the background.
+    Also returns the blurred square and the uncovered shadow, since the darkness is linear in their levels.
+    """
+    positions = np.arange(size) + 0.5
+    center, square_size, shift = parameters[:, 0:2], parameters[:, 2:4], parameters[:, 4:6]
+    blur = np.hypot(parameters[:, 6], min_blur)
+
+    square_start = center - square_size / 2
+    square_end = center + square_size / 2
+    shadow_start = square_start + shift
+    shadow_end = square_end + shift
+    covered_start = np.maximum(square_start, shadow_start)
+    covered_end = np.maximum(covered_start, np.minimum(square_end, shadow_end))
+
+    def render_boxes(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        columns = blurred_boxes(positions, starts[:, 0], ends[:, 0], blur)
+        rows = blurred_boxes(positions, starts[:, 1], ends[:, 1], blur)
+        return rows[:, :, None] * columns[:, None, :]
+
+    square = render_boxes(square_start, square_end)
+    shadow = render_boxes(shadow_start, shadow_end) - render_boxes(covered_start, covered_end)
+    levels = parameters[:, 7:10, None, None]
+    return levels[:, 0] * square + levels[:, 1] * shadow + levels[:, 2], square, shadow
+
+def get_covered_fractions(parameters: np.ndarray) -> np.ndarray:
+    """The fraction of every shadow covered by its back square, from the parameters of their models"""
+    square_sizes = parameters[:, 2:4]
+    return np.prod(np.clip(square_sizes - np.abs(parameters[:, 4:6]), 0, None), axis=1) / np.prod(square_sizes, axis=1)
+
+def fit_square_models(windows: np.ndarray, weights: np.ndarray, parameters: np.ndarray, fit_blur: bool) -> np.ndarray:
+    """
+    Fits the models of back squares and their shadows to windows of darkness by weighted least squares, with Levenberg-Marquardt steps.
+    Each window is fitted until its steps are below the tolerance. The blur is kept as it is unless it is fitted too.
+    """
+    num_windows, size = windows.shape[0], windows.shape[1]
+    geometry = list(range(7 if fit_blur else 6))
+    free = geometry + [7, 8, 9]
+    windows = windows.reshape(num_windows, -1)
+    weights = weights.reshape(num_windows, -1)
+    parameters = parameters.copy()
+    damping = np.full(num_windows, 1e-3)
+
+    model, square, shadow = (image.reshape(num_windows, -1) for image in render_square_models(parameters, size))
+    cost = np.sum(weights * (windows - model) ** 2, axis=1)
+    active = np.arange(num_windows)
+    for _ in range(fit_iterations):
+        # The darkness is linear in the levels, and the derivatives by the geometry are central differences
+        active_parameters = parameters[active]
+        jacobian = np.empty((len(active), len(free), size * size))
+        for index in geometry:
+            step = np.zeros(parameters.shape[1])
+            step[index] = derivative_step
+            forward = render_square_models(active_parameters + step, size)[0]
+            backward = render_square_models(active_parameters - step, size)[0]
+            jacobian[:, index] = ((forward - backward) / (2 * derivative_step)).reshape(len(active), -1)
+        jacobian[:, -3] = square[active]
+        jacobian[:, -2] = shadow[active]
+        jacobian[:, -1] = 1
+
+        weighted = jacobian * weights[active, None]
+        normal = weighted @ jacobian.transpose(0, 2, 1)
+        gradient = weighted @ (windows[active] - model[active])[:, :, None]
+        diagonal = np.diagonal(normal, axis1=1, axis2=2)
+        damped = normal + (damping[active, None] * diagonal + 1e-9)[:, :, None] * np.eye(len(free))
+        steps = np.linalg.solve(damped, gradient)[:, :, 0]
+
+        candidate = active_parameters.copy()
+        candidate[:, free] += steps
+        candidate_model, candidate_square, candidate_shadow = (image.reshape(len(active), -1) for image in render_square_models(candidate, size))
+        candidate_cost = np.sum(weights[active] * (windows[active] - candidate_model) ** 2, axis=1)
+
+        # Steps that lower the cost are taken and move further toward Gauss-Newton steps, others are retried shorter
+        improved = candidate_cost < cost[active]
+        taken = active[improved]
+        parameters[taken] = candidate[improved]
+        model[taken] = candidate_model[improved]
+        square[taken] = candidate_square[improved]
+        shadow[taken] = candidate_shadow[improved]
+        cost[taken] = candidate_cost[improved]
+        damping[active] = np.where(improved, damping[active] / 3, damping[active] * 5)
+
+        # Shadows mostly covered by their squares are left as they are, since they cannot be placed
+        converged = improved & np.all(np.abs(steps[:, :6]) < fit_tolerance, axis=1)
+        active = active[~converged & (get_covered_fractions(parameters[active]) <= max_covered_shadow)]
+        if len(active) == 0:
+            break
+
+    return parameters
+
+def find_initial_shifts(windows: np.ndarray, weights: np.ndarray, square_size: tuple[int, int], centers: np.ndarray, shadow_level: float) -> np.ndarray:
+    """
+    The whole pixel shift of every shadow, where a box the size of a square covers the most shadow and the least paper.
+    Of equal fits, the smallest shift is taken, since the rest of the shadow is hidden by its back square.
+    """
+    num_windows, size = windows.shape[0], windows.shape[1]
+    width, height = square_size
+
+    # Box sums at every position, from the integral image
+    gains = weights * (2 * windows - shadow_level)
+    integral = np.zeros((num_windows, size + 1, size + 1))
+    integral[:, 1:, 1:] = gains.cumsum(axis=1).cumsum(axis=2)
+    scores = integral[:, height:, width:] - integral[:, :-height, width:] - integral[:, height:, :-width] + integral[:, :-height, :-width]
+
+    box_centers_y, box_centers_x = np.mgrid[0:scores.shape[1], 0:scores.shape[2]]
+    shifts_x = box_centers_x[None] + width / 2 - centers[:, 0, None, None]
+    shifts_y = box_centers_y[None] + height / 2 - centers[:, 1, None, None]
+    scores = scores - 1e-6 * shadow_level * (shifts_x ** 2 + shifts_y ** 2)
+
+    best = scores.reshape(num_windows, -1).argmax(axis=1)
+    return np.stack([shifts_x.reshape(num_windows, -1)[np.arange(num_windows), best], shifts_y.reshape(num_windows, -1)[np.arange(num_windows), best]], axis=1)
+
+def measure_offset(scan: Image.Image, shadow_contrast: float = 0.03) -> OffsetMeasurement:
+    """
+    Measures the offset from a scan of the back page of a printed calibration sheet, lit so the front squares show through.
+
+    Every back square is paired with the shadow of its front square. Around each square, the scan is fitted with the blurred
+    back square and the part of the shadow it leaves uncovered, which gives their displacement however blurred the scan is.
+    Back squares are shifted by their coordinates, so each pair estimates the offset and the estimates are fitted together
+    with the skew between the pages.
+    """
+    rgb = np.asarray(scan.convert('RGB'), dtype=np.float32) / 255
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    luma = 0.299 * red + 0.587 * green + 0.114 * blue
+
+    # Most of the page is blank paper, and the red coordinate labels belong to neither grid
+    paper = np.percentile(luma, 75)
+    labels = red - np.maximum(green, blue) > 0.15
+    darkness = paper - luma
+    back = (darkness > paper * 0.5) & ~labels
+
+    # Front squares show through as an even shade, which is the most common darkness away from the blurred edges
+    # of the back squares and labels
+    printed = dilate((darkness > paper * 0.4) | labels, 3)
+    shades = darkness[(darkness > shadow_contrast) & ~printed]
+    if shades.size == 0:
+        raise Exception('Cannot find front squares showing through the scan. Light the front of the sheet more strongly.')
+    counts, bin_edges = np.histogram(shades, bins=64)
+    shadow_level = (bin_edges[np.argmax(counts)] + bin_edges[np.argmax(counts) + 1]) / 2
+    blueness = blue - np.maximum(red, green)
+
+    # Find the back squares column by column, so a slightly rotated scan still separates the columns
+    column_runs = find_square_runs(back.sum(axis=0), back.shape[0] * 0.05)
+    if len(column_runs) < 3:
+        raise Exception('Cannot find the squares of the calibration sheet in the scan.')
+
+    squares = []
+    for column_index, (column_start, column_end) in enumerate(column_runs):
+        for row_start, row_end in find_square_runs(back[:, column_start:column_end].sum(axis=1), (column_end - column_start) / 2):
+            # Refine the columns of this square, which may lean within the column
+            square_columns = find_runs(back[row_start:row_end, column_start:column_end].sum(axis=0) > (row_end - row_start) / 2)
+            if not square_columns:
+                continue
+            left = column_start + square_columns[0][0]
+            right = column_start + square_columns[-1][1]
+
+            squares.append((column_index, left, right, row_start, row_end, float(blueness[row_start:row_end, left:right].mean())))
+
+    if not squares:
+        raise Exception('Cannot find the squares of the calibration sheet in the scan.')
+
+    squares = np.array(squares)
+    column_indices = squares[:, 0].astype(int)
+    left, right, top, bottom = squares[:, 1], squares[:, 2], squares[:, 3], squares[:, 4]
+    center_x = (left + right) / 2
+    center_y = (top + bottom) / 2
+    is_blue = squares[:, 5] > 0.2
+    if not is_blue.any():
+        raise Exception('Cannot find the blue center squares of the calibration sheet in the scan.')
+
+    # Scale of the scan in pixels per pixel at 300 PPI, from the spacing of the back squares
+    column_centers = np.array([np.median(center_x[column_indices == index]) for index in range(len(column_runs))])
+    scale_x = np.median(np.diff(column_centers)) / back_square_spacing
+    row_spacings = [np.diff(np.sort(center_y[column_indices == index])) for index in range(len(column_runs))]
+    scale_y = np.median(np.concatenate(row_spacings)) / back_square_spacing
+
+    # Scans at twice 300 PPI or more are measured at a fraction of their size, since the offset is fitted to a fraction
+    # of a pixel anyway
+    reduction = math.floor(min(scale_x, scale_y))
+    if reduction >= 2:
+        return measure_offset(scan.reduce(reduction), shadow_contrast)
+
+    # Blue squares are the center column and row, which have coordinate 0
+    blue_counts = np.bincount(column_indices[is_blue], minlength=len(column_runs))
+    center_column = int(np.argmax(blue_counts))
+    center_row_y = np.median(center_y[is_blue & (column_indices != center_column)])
+
+    coordinates_x = column_indices - center_column
+    coordinates_y = np.zeros(len(squares))
+    for index in range(len(column_runs)):
+        in_column = column_indices == index
+        reference_y = center_y[in_column][np.argmin(np.abs(center_y[in_column] - center_row_y))]
+        coordinates_y[in_column] = np.round((center_y[in_column] - reference_y) / (back_square_spacing * scale_y))
+
+    # Every back square is fitted with its shadow, first to the whole pixel in a window reaching halfway to the next squares.
+    # Labels are left out wherever they tint the scan, since their blurred edges are darker than the shadows.
+    label_weights = ~dilate(red - np.maximum(green, blue) > 0.05, 2)
+    clear_weights = label_weights & ~dilate(darkness > 2 * shadow_level, 2)
+    padding = math.ceil(back_square_spacing * max(scale_x, scale_y))
+    padded_darkness, padded_label_weights, padded_clear_weights = (np.pad(image, padding) for image in (darkness, label_weights, clear_weights))
+    def get_windows(image: np.ndarray, window_left: np.ndarray, window_top: np.ndarray, size: int) -> np.ndarray:
+        # Windows reaching past the scan have no weight there
+        return sliding_window_view(image, (size, size))[window_top + padding, window_left + padding].astype(np.float64)
+
+    half_size = math.floor(back_square_spacing * min(scale_x, scale_y) / 2) - 1
+    window_left = np.round(center_x).astype(int) - half_size
+    window_top = np.round(center_y).astype(int) - half_size
+    square_width = float(np.median(right - left))
+    square_height = float(np.median(bottom - top))
+    shifts = find_initial_shifts(
+        get_windows(padded_darkness, window_left, window_top, 2 * half_size + 1),
+        get_windows(padded_clear_weights, window_left, window_top, 2 * half_size + 1),
+        (round(square_width), round(square_height)),
+        np.stack([center_x - window_left, center_y - window_top], axis=1),
+        shadow_level
+    )
+
+    # Then to a fraction of a pixel in windows around each square and its shadow, in batches of squares with similar windows
+    margin = fit_margin * max(scale_x, scale_y)
+    extents = np.stack([
+        np.maximum(center_x - half_size, center_x - square_width / 2 + np.minimum(shifts[:, 0], 0) - margin),
+        np.minimum(center_x + half_size, center_x + square_width / 2 + np.maximum(shifts[:, 0], 0) + margin),
+        np.maximum(center_y - half_size, center_y - square_height / 2 + np.minimum(shifts[:, 1], 0) - margin),
+        np.minimum(center_y + half_size, center_y + square_height / 2 + np.maximum(shifts[:, 1], 0) + margin)
+    ], axis=1)
+    sizes = np.ceil(np.maximum(extents[:, 1] - extents[:, 0], extents[:, 3] - extents[:, 2])).astype(int)
+
+    parameters = np.zeros((len(squares), 10))
+    parameters[:, 2:4] = square_width, square_height
+    parameters[:, 4:6] = shifts
+    parameters[:, 6] = 1
+    parameters[:, 7:10] = paper, shadow_level, 0
+    def fit_batch(batch_squares: np.ndarray, fit_blur: bool) -> np.ndarray:
+        size = int(sizes[batch_squares].max())
+        batch_left = np.floor((extents[batch_squares, 0] + extents[batch_squares, 1] - size) / 2).astype(int)
+        batch_top = np.floor((extents[batch_squares, 2] + extents[batch_squares, 3] - size) / 2).astype(int)
+
+        batch_parameters = parameters[batch_squares]
+        batch_parameters[:, 0] = center_x[batch_squares] - batch_left
+        batch_parameters[:, 1] = center_y[batch_squares] - batch_top
+        return fit_square_models(
+            get_windows(padded_darkness, batch_left, batch_top, size),
+            get_windows(padded_label_weights, batch_left, batch_top, size),
+            batch_parameters,
+            fit_blur
+        )
+
+    # The blur of the scan is fitted first from the shadows furthest from their squares, which show all their edges,
+    # and then kept for every square
+    order = np.argsort(sizes)
+    parameters[:, 6] = np.median(np.abs(fit_batch(order[-fit_batch_size:], True)[:, 6]))
+    for batch in range(0, len(squares), fit_batch_size):
+        batch_squares = order[batch:batch + fit_batch_size]
+        parameters[batch_squares] = fit_batch(batch_squares, False)
+
+    # A shadow mostly covered by its back square cannot be placed, nor can one fitted to something fainter than a shadow
+    placed = np.all(np.isfinite(parameters), axis=1) & (parameters[:, 8] >= shadow_contrast) & (get_covered_fractions(parameters) <= max_covered_shadow)
+    displacements = np.where(placed[:, None], parameters[:, 4:6], np.nan)
+
+    # A square whose shadow lines up exactly has the offset as its coordinates, and each pixel of displacement adds to it
+    estimates = np.stack([coordinates_x + displacements[:, 0] / scale_x, coordinates_y + displacements[:, 1] / scale_y], axis=1)
+    inliers = np.all(np.abs(estimates - np.nanmedian(estimates, axis=0)) <= max_estimate_deviation, axis=1)
+    if inliers.sum() < 3:
+        raise Exception('Cannot find enough front squares showing through the scan. Light the front of the sheet more strongly.')
+
+    # Fit the offset at the center of the grid and how it changes across the page, in pixels at 300 PPI
+    positions = np.stack([coordinates_x * back_square_spacing, coordinates_y * back_square_spacing], axis=1)[inliers]
+    design = np.column_stack([np.ones(len(positions)), positions])
+    fit, _, _, _ = np.linalg.lstsq(design, estimates[inliers], rcond=None)
+    residuals = estimates[inliers] - design @ fit
+
+    # A rotation moves x by -angle * y and y by angle * x
+    skew = (fit[1, 1] - fit[2, 0]) / 2
+
+    return OffsetMeasurement(
+        x_offset=float(fit[0, 0]),
+        y_offset=float(fit[0, 1]),
+        skew_degrees=math.degrees(skew),
+        residual=float(np.sqrt(np.mean(np.sum(residuals ** 2, axis=1)))),
+        num_squares=int(inliers.sum()),
+        num_found=len(squares)
+    )
+
+@click.command()
+@click.option("--scan_path", required=True, help="The path to a scan or photo of the back page of a printed calibration sheet, upright, with the front lit so its squares show through.")
+@click.option("--shadow_contrast", default=0.03, type=click.FloatRange(min=0, max=1, min_open=True), show_default=True, help="The minimum contrast with the paper of front squares showing through.")
+@click.option("-s", "--save", default=False, is_flag=True, help="Save the measured x and y offset values (legacy mode).")
+@click.option("--save_profile", help="Save the measured offset as a named profile (e.g., 'letter_printer', 'a4_office').")
+@click.option("--paper_size", type=click.Choice([t.value for t in PaperSize], case_sensitive=False), help="Paper size for the profile.")
+@click.option("--description", help="Description for the offset profile.")
+@click.option("--force", default=False, is_flag=True, help="Save the offset even when too few squares agree on it or they are too far from it.")
+
+def cli(scan_path, shadow_contrast, save, save_profile, paper_size, description, force):
+    with Image.open(scan_path) as scan:
+        # Photos are often stored sideways with an orientation tag
+        measurement = measure_offset(ImageOps.exif_transpose(scan), shadow_contrast)
+
+    x_offset = round(measurement.x_offset)
+    y_offset = round(measurement.y_offset)
+    print(f'Measured offset: x={measurement.x_offset:.2f}, y={measurement.y_offset:.2f} from {measurement.num_squares} of {measurement.num_found} squares')
+    print(f'Skew: {measurement.skew_degrees:.3f} degrees, residual: {measurement.residual:.2f} pixels')
+    print(f'Using x offset: {x_offset}, y offset: {y_offset}')
+
+    # A poor scan gives an offset that is not worth saving over a good one
+    problems = measurement.get_problems()
+    for problem in problems:
+        print(problem)
+    if problems and (save or save_profile) and not force:
+        raise Exception('Not saving the measured offset. Scan the sheet again with the front lit more evenly, or use "--force" to save it anyway.')
+
+    if save:
+        save_offset(x_offset, y_offset)
+
+    if save_profile:
+        save_offset_profile(
+            name=save_profile,
+            x_offset=x_offset,
+            y_offset=y_offset,
+            paper_size=paper_size or "",
+            description=description or f"Measured offset profile for {paper_size or 'custom setup'}"
+        )
+
+if __name__ == '__main__':
+    cli()
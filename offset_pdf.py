@@ -1,8 +1,18 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import ctypes
+import hashlib
+import itertools
 import os
+from typing import Iterator
+
 import click
+from PIL import Image
 import pypdfium2 as pdfium
 
 from utilities import (
+    PageCodec,
+    PdfWriter,
     load_saved_offset, 
     offset_images, 
     save_offset, 
@@ -16,6 +26,169 @@ from utilities import (
 output_directory = os.path.join('game', 'output')
 default_output_pdf_path = os.path.join(output_directory, 'game.pdf')
 
+# Per-process PDF for rendering pages in a process pool
+_worker_pdf: pdfium.PdfDocument | None = None
+
+def _init_page_worker(pdf_path: str):
+    global _worker_pdf
+    _worker_pdf = pdfium.PdfDocument(pdf_path)
+
+def _render_page_in_worker(page_number: int, ppi: int) -> Image.Image:
+    return _worker_pdf[page_number].render(ppi / 72).to_pil()
+
+def render_pages(pdf_path: str, pdf: pdfium.PdfDocument, ppi: int, jobs: int) -> Iterator[Image.Image]:
+    """
+    Yields the pages of a PDF rendered to images in page order, so pages can be written as they are rendered.
+    With more than one job, pages are rendered in a process pool that opens the PDF in every process,
+    with a bounded number of pages in flight.
+    """
+    if jobs <= 1 or len(pdf) <= 1:
+        for page_number in range(len(pdf)):
+            print(f"Page {page_number + 1}")
+            yield pdf[page_number].render(ppi / 72).to_pil()
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_page_worker, initargs=(pdf_path,)) as executor:
+        page_numbers = iter(range(len(pdf)))
+        in_flight = deque()
+
+        # Keep a couple of pages queued per worker so workers never idle while pages are written
+        for page_number in itertools.islice(page_numbers, jobs * 2):
+            in_flight.append((page_number, executor.submit(_render_page_in_worker, page_number, ppi)))
+
+        while in_flight:
+            page_number, future = in_flight.popleft()
+            image = future.result()
+
+            next_page_number = next(page_numbers, None)
+            if next_page_number is not None:
+                in_flight.append((next_page_number, executor.submit(_render_page_in_worker, next_page_number, ppi)))
+
+            print(f"Page {page_number + 1}")
+            yield image
+
+def get_vector_offset_problem(pdf: pdfium.PdfDocument) -> str | None:
+    """The reason the back pages of a PDF cannot be offset without rasterizing them, if there is one"""
+    for page_number in range(1, len(pdf), 2):
+        page = pdf[page_number]
+        if page.get_rotation() != 0:
+            return f'page {page_number + 1} is rotated'
+
+        mediabox = page.get_mediabox()
+        if mediabox[:2] != (0, 0) or page.get_cropbox() != mediabox:
+            return f'page {page_number + 1} has a crop box or does not start at the origin'
+
+        # Annotations are not part of the page content, so they would be lost
+        if pdfium.raw.FPDFPage_GetAnnotCount(page) > 0:
+            return f'page {page_number + 1} has annotations'
+
+    return None
+
+def get_segments_signature(get_segment, num_segments: int) -> tuple:
+    """The type, closing and end point of every segment of a path"""
+    x, y = ctypes.c_float(), ctypes.c_float()
+    segments = []
+    for index in range(num_segments):
+        segment = get_segment(index)
+        pdfium.raw.FPDFPathSegment_GetPoint(segment, x, y)
+        segments.append((pdfium.raw.FPDFPathSegment_GetType(segment), bool(pdfium.raw.FPDFPathSegment_GetClose(segment)), x.value, y.value))
+
+    return tuple(segments)
+
+def get_clip_signature(page_object: pdfium.PdfObject) -> tuple:
+    clip_path = pdfium.raw.FPDFPageObj_GetClipPath(page_object)
+    if not clip_path:
+        return ()
+
+    return tuple(
+        get_segments_signature(
+            lambda index: pdfium.raw.FPDFClipPath_GetPathSegment(clip_path, path_index, index),
+            pdfium.raw.FPDFClipPath_CountPathSegments(clip_path, path_index)
+        )
+        for path_index in range(pdfium.raw.FPDFClipPath_CountPaths(clip_path))
+    )
+
+def get_color_signature(get_color, page_object: pdfium.PdfObject) -> tuple:
+    channels = [ctypes.c_uint() for _ in range(4)]
+    get_color(page_object, *channels)
+    return tuple(channel.value for channel in channels)
+
+def get_path_signature(page_object: pdfium.PdfObject) -> tuple:
+    """The shape, painting and colors of a path"""
+    fill_mode, stroke = ctypes.c_int(), ctypes.c_int()
+    pdfium.raw.FPDFPath_GetDrawMode(page_object, fill_mode, stroke)
+    stroke_width = ctypes.c_float()
+    pdfium.raw.FPDFPageObj_GetStrokeWidth(page_object, stroke_width)
+
+    return (
+        get_segments_signature(lambda index: pdfium.raw.FPDFPath_GetPathSegment(page_object, index), pdfium.raw.FPDFPath_CountSegments(page_object)),
+        fill_mode.value,
+        stroke.value,
+        stroke_width.value,
+        get_color_signature(pdfium.raw.FPDFPageObj_GetFillColor, page_object),
+        get_color_signature(pdfium.raw.FPDFPageObj_GetStrokeColor, page_object)
+    )
+
+def get_page_signature(page: pdfium.PdfPage) -> tuple | None:
+    """
+    Identifies pages that only draw images and paths, like rendered pages, so identical pages can share one form XObject.
+    Pages with other content, like text, are never shared.
+    """
+    signature = [page.get_size()]
+    for page_object in page.get_objects(max_depth=1):
+        if page_object.type == pdfium.raw.FPDF_PAGEOBJ_IMAGE:
+            metadata = page_object.get_metadata()
+            content = (
+                hashlib.sha256(bytes(page_object.get_data(decode_simple=False))).hexdigest(),
+                tuple(page_object.get_filters()),
+                (metadata.width, metadata.height, metadata.bits_per_pixel, metadata.colorspace)
+            )
+        elif page_object.type == pdfium.raw.FPDF_PAGEOBJ_PATH:
+            content = get_path_signature(page_object)
+        else:
+            return None
+
+        signature.append((page_object.type, page_object.get_matrix().get(), get_clip_signature(page_object), content))
+
+    return tuple(signature)
+
+def offset_pdf_pages(pdf: pdfium.PdfDocument, output_pdf_path: str, x_offset: int, y_offset: int):
+    """
+    Offsets every other page by drawing it as a form XObject shifted by the offset, so no page is rasterized or re-encoded.
+    Front pages are copied as they are, and identical back pages share their form XObject.
+    Offsets are in pixels at 300 PPI, like offsets of rendered pages.
+    """
+    output_pdf = pdfium.PdfDocument.new()
+
+    # The y-axis of PDF points up, while offsets move content down the page
+    matrix = pdfium.PdfMatrix().translate(x_offset * 72 / 300, -y_offset * 72 / 300)
+    xobjects = {}
+
+    for page_number in range(len(pdf)):
+        print(f"Page {page_number + 1}")
+        if page_number % 2 == 0:
+            output_pdf.import_pages(pdf, [page_number])
+            continue
+
+        source_page = pdf[page_number]
+        signature = get_page_signature(source_page)
+        xobject = xobjects.get(signature) if signature is not None else None
+        if xobject is None:
+            xobject = pdf.page_as_xobject(page_number, output_pdf)
+            if signature is not None:
+                xobjects[signature] = xobject
+
+        page_object = xobject.as_pageobject()
+        page_object.transform(matrix)
+
+        width, height = source_page.get_size()
+
+        page = output_pdf.new_page(width, height)
+        page.insert_obj(page_object)
+        page.gen_content()
+
+    output_pdf.save(output_pdf_path)
+
 @click.command()
 @click.option("--pdf_path", default=default_output_pdf_path, help="The path of the input PDF.")
 @click.option("--output_pdf_path", help="The desired path of the offset PDF.")
@@ -28,9 +201,13 @@ default_output_pdf_path = os.path.join(output_directory, 'game.pdf')
 @click.option("--list_profiles", default=False, is_flag=True, help="List all saved offset profiles.")
 @click.option("--delete_profile", help="Delete a saved offset profile by name.")
 @click.option("--set_default", help="Set a profile as the default.")
-@click.option("--ppi", default=300, type=click.IntRange(min=0), show_default=True, help="Pixels per inch (PPI) when creating PDF.")
+@click.option("--rasterize", default=False, is_flag=True, help="Render every page to an image and offset the images, instead of shifting the page content. Used automatically for PDFs whose pages cannot be shifted.")
+@click.option("--ppi", default=300, type=click.IntRange(min=0), show_default=True, help="Pixels per inch (PPI) when rasterizing the PDF.")
+@click.option("--quality", default=100, type=click.IntRange(min=0, max=100), show_default=True, help="File compression when rasterizing the PDF. A higher value corresponds to better quality and larger file size.")
+@click.option("--jobs", default=1, type=click.IntRange(min=1), show_default=True, help="Number of processes used to render pages and threads used to encode them in parallel when rasterizing the PDF.")
+@click.option("--codec", default=PageCodec.JPEG.value, type=click.Choice([t.value for t in PageCodec], case_sensitive=False), show_default=True, help="Compression of PDF pages when rasterizing the PDF. 'flate' is lossless, 'auto' uses flate for pages with few colors and JPEG otherwise.")
 
-def offset_pdf(pdf_path, output_pdf_path, x_offset, y_offset, save, save_profile, paper_size, description, list_profiles, delete_profile, set_default, ppi):
+def offset_pdf(pdf_path, output_pdf_path, x_offset, y_offset, save, save_profile, paper_size, description, list_profiles, delete_profile, set_default, rasterize, ppi, quality, jobs, codec):
     
     # Handle profile management commands first
     if list_profiles:
@@ -100,21 +277,24 @@ def offset_pdf(pdf_path, output_pdf_path, x_offset, y_offset, save, save_profile
     try:
         pdf = pdfium.PdfDocument(pdf_path)
 
-        # Get all the raw page images from the PDF
-        raw_images = []
-        for page_number in range(len(pdf)):
-            print(f"Page {page_number + 1}")
-            page = pdf.get_page(page_number)
-            raw_images.append(page.render(ppi/72).to_pil())
-
-        # Offset images
-        final_images = offset_images(raw_images, new_x_offset, new_y_offset, ppi)
-
         # The default for output_pdf_path is the original path but with _offset.py appended to the end.
         if output_pdf_path is None:
             output_pdf_path = f'{pdf_path.removesuffix(".pdf")}_offset.pdf'
 
-        final_images[0].save(output_pdf_path, save_all=True, append_images=final_images[1:], resolution=ppi, speed=0, subsampling=0, quality=100)
+        # Shift the page content when possible, which keeps the pages as they are
+        if not rasterize:
+            problem = get_vector_offset_problem(pdf)
+            if problem is None:
+                offset_pdf_pages(pdf, output_pdf_path, new_x_offset, new_y_offset)
+                print(f'Offset PDF: {output_pdf_path}')
+                return
+
+            print(f'Rasterizing the PDF because {problem}')
+
+        # Pages are rendered, offset and written one at a time, so the document is never held in memory
+        with PdfWriter(output_pdf_path, ppi, quality, jobs, codec) as writer:
+            for image in offset_images(render_pages(pdf_path, pdf, ppi, jobs), new_x_offset, new_y_offset, ppi):
+                writer.add_page(image)
         print(f'Offset PDF: {output_pdf_path}')
     except FileNotFoundError as e:
         print(f"Cannot offset nonexistent PDF: {e}")
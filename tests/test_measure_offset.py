@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+repo_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_directory)
+
+from calibration import draw_calibration_sheet
+from measure_offset import OffsetMeasurement, measure_offset
+from utilities import PaperSize
+
+def scan_calibration_sheet(x_offset: float, y_offset: float, blur: float) -> Image.Image:
+    """A blurred and noisy scan of the back page of a letter calibration sheet printed with the given offset"""
+    front, back = draw_calibration_sheet(PaperSize.LETTER, 300)
+
+    # The front squares show through the back page as a faint shadow
+    front_squares = Image.fromarray(((np.asarray(front.convert('L')) < 128) * 255).astype(np.uint8))
+    front_squares = front_squares.transform(front.size, Image.AFFINE, (1, 0, -x_offset, 0, 1, -y_offset), Image.BILINEAR)
+    shadow = np.asarray(front_squares, dtype=np.float32) / 255
+    scan = np.asarray(back, dtype=np.float32) * (1 - 0.12 * shadow[..., None])
+
+    scan = Image.fromarray(np.clip(scan, 0, 255).astype(np.uint8)).filter(ImageFilter.GaussianBlur(blur))
+    noisy_scan = np.asarray(scan, dtype=np.float32) + np.random.default_rng(0).normal(0, 3, (scan.height, scan.width, 3))
+    return Image.fromarray(np.clip(noisy_scan, 0, 255).astype(np.uint8))
+
+def test_measures_blurred_offset(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.chdir(repo_directory)
+    measurement = measure_offset(scan_calibration_sheet(5, -3, 2))
+
+    assert measurement.x_offset == pytest.approx(5, abs=0.3)
+    assert measurement.y_offset == pytest.approx(-3, abs=0.3)
+    assert measurement.skew_degrees == pytest.approx(0, abs=0.01)
+    assert measurement.get_problems() == []
+
+def test_reports_untrustworthy_offset():
+    measurement = OffsetMeasurement(x_offset=0, y_offset=0, skew_degrees=0, residual=1.5, num_squares=100, num_found=500)
+
+    assert len(measurement.get_problems()) == 2
@@ -1,4 +1,10 @@
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
 from enum import Enum
+import functools
+import hashlib
+import io
 import itertools
 import json
 import math
@@ -8,11 +14,15 @@ import re
 import shutil
 import subprocess
 import tempfile
-from typing import Dict, List
+import threading
+import time
+from typing import Callable, ClassVar, Dict, Iterable, Iterator, List
 from xml.dom import ValidationErr
+import zlib
 
 from natsort import natsorted
-from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
+import numpy as np
+from PIL import ExifTags, Image, ImageChops, ImageDraw, ImageFont, ImageOps
 from pydantic import BaseModel
 
 # Specify directory locations
@@ -44,6 +54,36 @@ class Registration(str, Enum):
     THREE = "3"
     FOUR = "4"
 
+class ImageFormat(str, Enum):
+    PNG = "png"
+    TIFF = "tiff"
+
+class PageCodec(str, Enum):
+    JPEG = "jpeg"
+    FLATE = "flate"
+    JPEG2000 = "jpeg2000"
+    AUTO = "auto"
+
+class Subsampling(str, Enum):
+    S444 = "4:4:4"
+    S422 = "4:2:2"
+    S420 = "4:2:0"
+
+class ResampleQuality(str, Enum):
+    DRAFT = "draft"
+    FAST = "fast"
+    HIGH = "high"
+    BEST = "best"
+
+# The resampling filter and reducing gap of each quality preset
+# A reducing gap first reduces large images by an integer factor, which is faster but less precise
+resample_settings = {
+    ResampleQuality.DRAFT: (Image.Resampling.BILINEAR, 2.0),
+    ResampleQuality.FAST: (Image.Resampling.BICUBIC, 2.0),
+    ResampleQuality.HIGH: (Image.Resampling.BICUBIC, None),
+    ResampleQuality.BEST: (Image.Resampling.LANCZOS, None)
+}
+
 class CardLayoutSize(BaseModel):
     width: int
     height: int
@@ -62,6 +102,10 @@ class Layouts(BaseModel):
     card_sizes: Dict[CardSize, CardLayoutSize]
     paper_layouts: Dict[PaperSize, PaperLayout]
 
+class OffsetData(BaseModel):
+    x_offset: int
+    y_offset: int
+
 # Known junk files across OSes
 EXTRANEOUS_FILES = {
     ".DS_Store",
@@ -175,125 +219,1925 @@ def get_back_card_image_path(back_dir_path) -> str | None:
 
     return os.path.join(back_dir_path, files[index])
 
-def draw_card_with_bleed(card_image: Image, base_image: Image, box: tuple[int, int, int, int], print_bleed: tuple[int, int]):
-    origin_x, origin_y, _, _ = box
-
-    x_bleed = print_bleed[0]
-    y_bleed = print_bleed[1]
+class Tracer:
+    """
+    Records nested spans as Chrome trace events, which can be opened in chrome://tracing or Perfetto.
+    """
 
-    width, height = card_image.size
-    base_image.paste(card_image, (origin_x, origin_y))
+    def __init__(self):
+        self.events: List[dict] = []
 
-    class Axis(int, Enum):
-        X = 0
-        Y = 1
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': start / 1000,
+                'dur': (time.perf_counter_ns() - start) / 1000,
+                'pid': os.getpid(),
+                'tid': threading.get_native_id(),
+                'args': args
+            })
+
+    def drain(self) -> List[dict]:
+        events, self.events = self.events, []
+        return events
+
+    def summary(self) -> str:
+        """A table of the count, total time and self time (excluding nested spans) of each span name"""
+        stats: Dict[str, List[float]] = {}
+
+        threads: Dict[tuple, List[dict]] = {}
+        for event in self.events:
+            threads.setdefault((event['pid'], event['tid']), []).append(event)
+
+        for thread_events in threads.values():
+            # Spans on one thread nest, so the enclosing span is the closest open span on the stack
+            stack: List[tuple[dict, List[float]]] = []
+            for event in sorted(thread_events, key=lambda event: (event['ts'], -event['dur'])):
+                while stack and stack[-1][0]['ts'] + stack[-1][0]['dur'] <= event['ts']:
+                    stack.pop()
+
+                stat = stats.setdefault(event['name'], [0, 0, 0, 0])
+                stat[0] += 1
+                stat[1] += event['dur']
+                stat[2] += event['dur']
+                stat[3] = max(stat[3], event['dur'])
+
+                if stack:
+                    stack[-1][1][2] -= event['dur']
+                stack.append((event, stat))
+
+        lines = [f'{"Span":<24} {"Count":>7} {"Total (s)":>10} {"Self (s)":>10} {"Mean (ms)":>10} {"Max (ms)":>10}']
+        for name, (count, total, self_time, longest) in sorted(stats.items(), key=lambda item: -item[1][2]):
+            lines.append(f'{name:<24} {count:>7} {total / 1e6:>10.3f} {self_time / 1e6:>10.3f} {total / count / 1e3:>10.2f} {longest / 1e3:>10.2f}')
+
+        return '\n'.join(lines)
+
+    def save(self, path: str):
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace_file)
+
+# The tracer of this process, which is None unless tracing is enabled
+_tracer: Tracer | None = None
+
+# Disabled spans share one context, so tracing costs a function call when it is off
+_null_span = contextlib.nullcontext({})
+
+def trace_span(name: str, **args):
+    """
+    A context manager that records a span when tracing is enabled.
+    It yields a dict of span arguments, which can be added to while the span is open.
+    """
+    if _tracer is None:
+        return _null_span
 
-    def extend_edge(crop_box: tuple[int, int, int, int], start: tuple[int, int], bleed: int, axis: Axis):
-        for bleed_i in range(bleed):
-            pos = (
-                start[0] + (bleed_i if axis == Axis.X else 0),
-                start[1] + (bleed_i if axis == Axis.Y else 0)
-            )
+    return _tracer.span(name, **args)
 
-            base_image.paste(card_image.crop(crop_box), pos)
+def get_tracer() -> Tracer | None:
+    return _tracer
 
-    # Extend the edges of the cards to create print bleed
-    # Top and bottom
-    extend_edge((0, 0, width, 1), (origin_x, origin_y - y_bleed), y_bleed, Axis.Y)
-    extend_edge((0, height - 1, width, height), (origin_x, origin_y + height), y_bleed, Axis.Y)
+def start_tracing() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
 
-    # Left and right
-    extend_edge((0, 0, 1, height), (origin_x - x_bleed, origin_y), x_bleed, Axis.X)
-    extend_edge((width - 1, 0, width, height), (origin_x + width, origin_y), x_bleed, Axis.X)
+@contextlib.contextmanager
+def tracing(trace_path: str | None):
+    """Traces everything run within the context and saves the trace, if a trace path is given"""
+    global _tracer
 
-    # Corners
-    for x_bleed, crop_x, pos_x in [(x_bleed, 0, origin_x - x_bleed), (x_bleed, width - 1, origin_x + width)]:
-        for y_bleed, crop_y, pos_y in [(y_bleed, 0, origin_y - y_bleed), (y_bleed, height - 1, origin_y + height)]:
-            for x_bleed_i in range(x_bleed):
-                for y_bleed_i in range(y_bleed):
-                    base_image.paste(card_image.crop((crop_x, crop_y, crop_x + 1, crop_y + 1)), (pos_x + x_bleed_i, pos_y + y_bleed_i))
+    if trace_path is None:
+        yield
+        return
 
-    return base_image
+    tracer = start_tracing()
+    try:
+        with trace_span('generate_pdf'):
+            yield
+    finally:
+        _tracer = None
+        tracer.save(trace_path)
+
+        print(tracer.summary())
+        print(f'Saved trace: {trace_path}')
+
+def clamp_print_bleed(base_size: tuple[int, int], box: tuple[int, int, int, int], print_bleed: tuple[int, int]) -> tuple[int, int, int, int]:
+    """Limits the print bleed on each side of a card to the page, returned as (left, top, right, bottom)"""
+    base_width, base_height = base_size
+    origin_x, origin_y, width, height = box
+    x_bleed, y_bleed = print_bleed
+
+    return (
+        max(0, min(x_bleed, origin_x)),
+        max(0, min(y_bleed, origin_y)),
+        max(0, min(x_bleed, base_width - (origin_x + width))),
+        max(0, min(y_bleed, base_height - (origin_y + height)))
+    )
 
-def draw_card_layout(
-    card_images: List[Image.Image | None],
-    base_image: Image.Image,
-    num_rows: int,
-    num_cols: int,
-    x_pos: List[int],
-    y_pos: List[int],
+def add_print_bleed(card_image: Image.Image, bleed: tuple[int, int, int, int]) -> Image.Image:
+    left_bleed, top_bleed, right_bleed, bottom_bleed = bleed
+
+    # Extend the edges and corners of the card to create print bleed by replicating the outermost pixels
+    card_array = np.asarray(card_image)
+    pad_width = [(top_bleed, bottom_bleed), (left_bleed, right_bleed)] + [(0, 0)] * (card_array.ndim - 2)
+
+    return Image.fromarray(np.pad(card_array, pad_width, mode='edge'))
+
+def resize_with_shift(
+    image: Image.Image,
+    size: tuple[int, int],
+    shift: tuple[float, float],
+    box: tuple[float, float, float, float] | None = None,
+    resample_quality: ResampleQuality = ResampleQuality.HIGH
+) -> Image.Image:
+    """Resizes a region of an image and shifts its content by a fraction of a pixel of the resized image in the same resample"""
+    resample, reducing_gap = resample_settings[resample_quality]
+    if box is None:
+        box = (0, 0, image.width, image.height)
+
+    shift_x, shift_y = shift
+    if shift_x == 0 and shift_y == 0:
+        return image.resize(size, resample, box, reducing_gap)
+
+    scale_x = (box[2] - box[0]) / size[0]
+    scale_y = (box[3] - box[1]) / size[1]
+
+    # The shifted box may reach past the image, so extend its edges to cover every sample of the resample filter
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGBA')
+    pad = math.ceil(max(scale_x, scale_y) * 3) + 2
+    image_array = np.asarray(image)
+    padding = ((pad, pad), (pad, pad)) + ((0, 0),) * (image_array.ndim - 2)
+    padded_image = Image.fromarray(np.pad(image_array, padding, mode='edge'))
+
+    left = pad + box[0] - shift_x * scale_x
+    top = pad + box[1] - shift_y * scale_y
+    return padded_image.resize(size, resample, (left, top, left + box[2] - box[0], top + box[3] - box[1]), reducing_gap)
+
+def prepare_card_tile(
+    card_image: Image.Image,
     width: int,
     height: int,
-    print_bleed: tuple[int, int],
     crop: tuple[float, float],
     ppi_ratio: float,
     extend_corners: int,
-    flip: bool
-):
-    num_cards = num_rows * num_cols
+    flip: bool,
+    bleed: tuple[int, int, int, int],
+    shift: tuple[float, float] = (0, 0),
+    resample_quality: ResampleQuality = ResampleQuality.HIGH
+) -> Image.Image:
+    """
+    Transforms a card image into the tile that is pasted into its slot, including print bleed.
+
+    The crop, the resize to the card layout and the extend_corners trim are a single resample of the source region,
+    so no full-size intermediate image is created. The card is also shifted by a fraction of a pixel in that resample,
+    so offsets are exact at any ppi.
+    """
+    card_width, card_height = card_image.size
+
+    # Crop the outer portion of a card to remove preexisting print bleed
+    crop_x_percent, crop_y_percent = crop
+    crop_x = math.floor(card_width / 2 * (crop_x_percent / 100))
+    crop_y = math.floor(card_height / 2 * (crop_y_percent / 100))
+
+    # The cropped card is resized to the card layout, then extend_corners is trimmed from every side
+    layout_width = math.floor(width * ppi_ratio)
+    layout_height = math.floor(height * ppi_ratio)
+    extend_corners_ppi = math.floor(extend_corners * ppi_ratio)
+    trim_x = extend_corners_ppi * (card_width - 2 * crop_x) / layout_width
+    trim_y = extend_corners_ppi * (card_height - 2 * crop_y) / layout_height
+
+    box = (crop_x + trim_x, crop_y + trim_y, card_width - crop_x - trim_x, card_height - crop_y - trim_y)
+    size = (layout_width - 2 * extend_corners_ppi, layout_height - 2 * extend_corners_ppi)
+
+    # The box is centered on the card, so back images can be rotated after the resample instead of before it
+    if flip:
+        shift = (-shift[0], -shift[1])
+
+    with trace_span('resample', source_size=card_image.size):
+        card_image = resize_with_shift(card_image, size, shift, box, resample_quality)
+
+    if flip:
+        # Rotate the back image to account for orientation
+        with trace_span('rotate'):
+            card_image = card_image.transpose(Image.Transpose.ROTATE_180)
+
+    # Pages are RGB, so match the mode before replicating edges
+    if card_image.mode != 'RGB':
+        with trace_span('convert', mode=card_image.mode):
+            card_image = card_image.convert('RGB')
+
+    with trace_span('bleed'):
+        return add_print_bleed(card_image, bleed)
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def hash_files(paths: List[str]) -> Dict[str, str]:
+    """Fingerprints the content of many files in parallel"""
+    unique_paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor() as executor:
+        return dict(zip(unique_paths, executor.map(hash_file, unique_paths)))
+
+class TileStore:
+    """
+    Persistent cache of prepared card tiles shared between runs, bounded in size by least recently used eviction.
+
+    Tiles are stored as raw arrays, so a hit is a memory-mapped read instead of a decode, crop and resize.
+    """
+
+    # Increase when the tile pipeline changes so stale tiles are never reused
+    version = 1
+
+    def __init__(self, directory: str, max_size_mb: int):
+        self.directory = os.path.join(directory, 'tiles')
+        self.max_size = max_size_mb * 1024 * 1024
+
+    def _path(self, key: tuple) -> str:
+        digest = hashlib.sha256(repr((self.version, *key)).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f'{digest}.npy')
+
+    def load(self, key: tuple) -> Image.Image | None:
+        path = self._path(key)
+        try:
+            tile = Image.fromarray(np.load(path, mmap_mode='r'))
+        except (OSError, ValueError):
+            return None
+
+        # Mark the tile as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return tile
+
+    def save(self, key: tuple, tile: Image.Image):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so concurrent runs never read a partial tile
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as temp_file:
+            try:
+                np.save(temp_file, np.asarray(tile))
+            except BaseException:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+
+        # A temporary file is not counted by evict, so it is never left behind
+        try:
+            os.replace(temp_file.name, path)
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+
+    def evict(self):
+        """Deletes the least recently used tiles until the cache fits within its maximum size"""
+        entries = []
+        for current_folder, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(current_folder, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+class CardTileCache:
+    """
+    Prepared card tiles of a single run, keyed by image content and every parameter that affects the tile.
+
+    Identical images (for example, many copies of the same basic land) are decoded and transformed once.
+    Only tiles of images that are used more than once are kept, so unique cards do not accumulate in memory,
+    and the least recently used tiles are dropped to stay within the memory budget, if one is provided.
+    Tiles are also looked up in and added to the persistent tile store, if one is provided.
+
+    Card images are opened right before they are decoded and closed as soon as their tile is prepared,
+    so at most one decoded card image is alive at a time.
+    """
+
+    def __init__(self, image_hashes: Dict[str, str] | None = None, reused_hashes: set[str] | None = None, tile_store: TileStore | None = None, max_memory_mb: float | None = None):
+        self.image_hashes = image_hashes or {}
+        self.reused_hashes = reused_hashes or set()
+        self.tile_store = tile_store
+        self.max_memory = None if max_memory_mb is None else max_memory_mb * 1024 * 1024
+
+        self.tiles: OrderedDict[tuple, Image.Image] = OrderedDict()
+        self.memory = 0
+
+    def _keep_tile(self, key: tuple, tile: Image.Image):
+        """Keeps a tile in memory, dropping the least recently used tiles to stay within the memory budget"""
+        tile_memory = tile.width * tile.height * len(tile.getbands())
+        if key in self.tiles or (self.max_memory is not None and tile_memory > self.max_memory):
+            return
+
+        self.tiles[key] = tile
+        self.memory += tile_memory
+
+        while self.max_memory is not None and self.memory > self.max_memory:
+            _, dropped_tile = self.tiles.popitem(last=False)
+            self.memory -= dropped_tile.width * dropped_tile.height * len(dropped_tile.getbands())
+
+    def get_tile(self, image_path: str, params: tuple, prepare: Callable[[Image.Image], Image.Image], draft_size: tuple[int, int] | None = None) -> Image.Image:
+        """
+        Returns the tile of an image for the given parameters, preparing it from the decoded image if needed.
+        With a draft size, JPEG images are decoded at a reduced scale that is still at least that size.
+        """
+        with trace_span('card', image=os.path.basename(image_path)) as span_args:
+            image_hash = self.image_hashes.get(image_path)
+            if image_hash is None:
+                image_hash = hash_file(image_path)
+                self.image_hashes[image_path] = image_hash
+
+            key = (image_hash, *params)
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            span_args['source'] = 'memory'
+
+            if tile is None and self.tile_store is not None:
+                with trace_span('tile store load'):
+                    tile = self.tile_store.load(key)
+                span_args['source'] = 'tile store'
+
+            if tile is None:
+                with Image.open(image_path) as card_image:
+                    # Only JPEG images can be decoded at a reduced scale
+                    if draft_size is not None and card_image.format == 'JPEG':
+                        # The draft size is in the stored orientation, before the EXIF orientation is applied
+                        if card_image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                            draft_size = (draft_size[1], draft_size[0])
+                        card_image.draft(None, draft_size)
+
+                    with trace_span('decode', format=card_image.format, mode=card_image.mode, size=card_image.size):
+                        card_image.load()
+
+                    # Transposing in place avoids copying every image that is already upright
+                    with trace_span('exif transpose'):
+                        ImageOps.exif_transpose(card_image, in_place=True)
+
+                    with trace_span('prepare tile'):
+                        tile = prepare(card_image)
+                span_args['source'] = 'image'
+
+                if self.tile_store is not None:
+                    with trace_span('tile store save'):
+                        self.tile_store.save(key, tile)
+
+            if image_hash in self.reused_hashes:
+                self._keep_tile(key, tile)
+
+            span_args['tile_size'] = tile.size
+            return tile
+
+@functools.lru_cache(maxsize=None)
+def load_layouts() -> Layouts:
+    """Loads and validates the layouts once per process"""
+    with open(layouts_path, 'r') as layouts_file:
+        try:
+            layouts_data = json.load(layouts_file)
+            return Layouts(**layouts_data)
+
+        except ValidationErr as e:
+            raise Exception(f'Cannot parse layouts.json: {e}.')
+
+class CardSlot(BaseModel):
+    """Where a card is placed on a page in pixels, inside extend_corners, with the print bleed around it"""
+    x: int
+    y: int
+    bleed: tuple[int, int, int, int]
+
+class SlotPlan(BaseModel):
+    """The geometry of every card slot of a card layout on a page at one ppi, shared by every sheet"""
+    ppi_ratio: float
+    page_size: tuple[int, int]
+    card_layout_size: CardLayoutSize
+    extend_corners: int
+    card_size: tuple[int, int]
+    front_slots: List[CardSlot]
+
+    # Back slots are in flipped row order
+    back_slots: List[CardSlot]
+
+def compile_slot_plan(
+    card_layout: CardLayout,
+    card_layout_size: CardLayoutSize,
+    page_size: tuple[int, int],
+    max_print_bleed: tuple[int, int],
+    ppi: int,
+    extend_corners: int
+) -> SlotPlan:
+    ppi_ratio = ppi / 300
+    num_rows = len(card_layout.y_pos)
+    num_cols = len(card_layout.x_pos)
+
+    extend_corners_ppi = math.floor(extend_corners * ppi_ratio)
+    card_width = math.floor(card_layout_size.width * ppi_ratio) - (2 * extend_corners_ppi)
+    card_height = math.floor(card_layout_size.height * ppi_ratio) - (2 * extend_corners_ppi)
+    scaled_print_bleed = tuple(math.ceil(bleed * ppi_ratio) + extend_corners_ppi for bleed in max_print_bleed)
+
+    def make_slot(x_pos: int, y_pos: int) -> CardSlot:
+        origin_x = math.floor(x_pos * ppi_ratio) + extend_corners_ppi
+        origin_y = math.floor(y_pos * ppi_ratio) + extend_corners_ppi
+        bleed = clamp_print_bleed(page_size, (origin_x, origin_y, card_width, card_height), scaled_print_bleed)
+
+        return CardSlot(x=origin_x, y=origin_y, bleed=bleed)
+
+    # Slots are numbered left to right, then top to bottom
+    front_slots = []
+    back_slots = []
+    for i in range(num_rows * num_cols):
+        x_pos = card_layout.x_pos[i % num_cols]
+        front_slots.append(make_slot(x_pos, card_layout.y_pos[i // num_cols]))
+        back_slots.append(make_slot(x_pos, card_layout.y_pos[num_rows - (i // num_cols) - 1]))
+
+    return SlotPlan(
+        ppi_ratio=ppi_ratio,
+        page_size=page_size,
+        card_layout_size=card_layout_size,
+        extend_corners=extend_corners,
+        card_size=(card_width, card_height),
+        front_slots=front_slots,
+        back_slots=back_slots
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_slot_plan(paper_size: PaperSize, card_size: CardSize, registration: Registration, ppi: int, extend_corners: int) -> SlotPlan:
+    """
+    Compiles the slot plan of a paper size and card size once per process.
+    Registration pages may differ in size from the paper layout, so slots are clamped to the scaled registration page.
+    """
+    layouts = load_layouts()
+    paper_layout = layouts.paper_layouts[paper_size]
+    card_layout = paper_layout.card_layouts[card_size]
+    card_layout_size = layouts.card_sizes[card_size]
+
+    ppi_ratio = ppi / 300
+    with Image.open(get_registration_path(paper_size, registration)) as reg_im:
+        page_size = (math.floor(reg_im.width * ppi_ratio), math.floor(reg_im.height * ppi_ratio))
 
-    # Fill all the spaces with the card back
-    for i, card_image in enumerate(card_images):
-        if card_image is None:
+    max_print_bleed = calculate_max_print_bleed(card_layout.x_pos, card_layout.y_pos, card_layout_size.width, card_layout_size.height, paper_layout.width, paper_layout.height)
+
+    return compile_slot_plan(card_layout, card_layout_size, page_size, max_print_bleed, ppi, extend_corners)
+
+def get_registration_path(paper_size: PaperSize, registration: Registration) -> str:
+    registration_filename = f'{PaperSize(paper_size).value}_registration_{Registration(registration).value}.jpg'
+    return os.path.join(asset_directory, registration_filename)
+
+def draw_card_layout(
+    card_image_paths: List[str | None],
+    base_image: Image.Image,
+    slot_plan: SlotPlan,
+    crop: tuple[float, float],
+    flip: bool,
+    tile_cache: CardTileCache,
+    offset: tuple[float, float] = (0, 0),
+    resample_quality: ResampleQuality = ResampleQuality.HIGH
+):
+    # Fill all the spaces with the card images
+    for card_image_path, slot, position in zip(card_image_paths, *get_slot_positions(slot_plan, flip, offset)):
+        if card_image_path is None:
             continue
 
-        # Calculate the location of the new card based on what number the card is
-        new_origin_x = math.floor(x_pos[i % num_cards % num_cols] * ppi_ratio)
-        new_origin_y = math.floor(y_pos[(i % num_cards) // num_cols] * ppi_ratio)
+        tile = get_card_tile(card_image_path, slot_plan, crop, flip, slot.bleed, get_offset_shift(offset), tile_cache, resample_quality)
 
-        if flip:
-            new_origin_y = math.floor(y_pos[num_rows - ((i % num_cards) // num_cols) - 1] * ppi_ratio)
+        with trace_span('paste'):
+            base_image.paste(tile, position)
 
-            # Rotate the back image to account for orientation
-            card_image = card_image.rotate(180)
+def draw_card_layout_bands(
+    card_image_paths: List[str | None],
+    draw_background: Callable[[int, int], Image.Image],
+    slot_plan: SlotPlan,
+    band_height: int,
+    crop: tuple[float, float],
+    flip: bool,
+    tile_cache: CardTileCache,
+    offset: tuple[float, float] = (0, 0),
+    resample_quality: ResampleQuality = ResampleQuality.HIGH
+) -> Iterator[Image.Image]:
+    """
+    Yields a page in horizontal bands from the top, so only one band of the page is held in memory.
+    Each band starts from the background drawn for its rows and only has the cards that intersect it pasted in.
+    Tiles are prepared when the first band reaches them and dropped after the last band they intersect.
+    """
+    card_width, card_height = slot_plan.card_size
+    shift = get_offset_shift(offset)
+
+    # Cards in the order that bands reach them, with the rows their tiles cover
+    placements = deque(sorted(
+        (
+            (y, y + card_height + slot.bleed[1] + slot.bleed[3], x, card_image_path, slot)
+            for card_image_path, slot, (x, y) in zip(card_image_paths, *get_slot_positions(slot_plan, flip, offset))
+            if card_image_path is not None
+        ),
+        key=lambda placement: placement[0]
+    ))
+
+    active_tiles = []
+    page_height = slot_plan.page_size[1]
+    for band_top in range(0, page_height, band_height):
+        band_bottom = min(band_top + band_height, page_height)
+        with trace_span('band background', top=band_top):
+            band = draw_background(band_top, band_bottom - band_top)
+
+        while placements and placements[0][0] < band_bottom:
+            tile_top, tile_bottom, x, card_image_path, slot = placements.popleft()
+            tile = get_card_tile(card_image_path, slot_plan, crop, flip, slot.bleed, shift, tile_cache, resample_quality)
+            active_tiles.append((tile_top, tile_bottom, x, tile))
+
+        # Pasting clips each tile to the rows of the band
+        with trace_span('paste', top=band_top):
+            for tile_top, tile_bottom, x, tile in active_tiles:
+                if tile_bottom > band_top:
+                    band.paste(tile, (x, tile_top - band_top))
+
+        active_tiles = [active_tile for active_tile in active_tiles if active_tile[1] > band_bottom]
+
+        yield band
+
+def get_offset_shift(offset: tuple[float, float]) -> tuple[float, float]:
+    """The fraction of a pixel of an offset, which is applied when tiles are resized"""
+    return (offset[0] - math.floor(offset[0]), offset[1] - math.floor(offset[1]))
+
+def get_slot_positions(slot_plan: SlotPlan, flip: bool, offset: tuple[float, float]) -> tuple[List[CardSlot], List[tuple[int, int]]]:
+    """The slots of a side of a page and where their tiles are pasted, moved by the whole pixels of the offset"""
+    offset_x = math.floor(offset[0])
+    offset_y = math.floor(offset[1])
+    slots = slot_plan.back_slots if flip else slot_plan.front_slots
+
+    return slots, [(slot.x + offset_x - slot.bleed[0], slot.y + offset_y - slot.bleed[1]) for slot in slots]
+
+def get_card_tile(
+    card_image_path: str,
+    slot_plan: SlotPlan,
+    crop: tuple[float, float],
+    flip: bool,
+    bleed: tuple[int, int, int, int],
+    shift: tuple[float, float],
+    tile_cache: CardTileCache,
+    resample_quality: ResampleQuality
+) -> Image.Image:
+    width = slot_plan.card_layout_size.width
+    height = slot_plan.card_layout_size.height
+    ppi_ratio = slot_plan.ppi_ratio
+    extend_corners = slot_plan.extend_corners
+
+    return tile_cache.get_tile(
+        card_image_path,
+        (width, height, crop, ppi_ratio, extend_corners, flip, bleed, shift, resample_quality),
+        lambda card_image: prepare_card_tile(card_image, width, height, crop, ppi_ratio, extend_corners, flip, bleed, shift, resample_quality),
+        (math.floor(width * ppi_ratio), math.floor(height * ppi_ratio)) if resample_quality == ResampleQuality.DRAFT else None
+    )
 
-        # Crop the outer portion of a card to remove preexisting print bleed
-        crop_x_percent, crop_y_percent = crop
-        if crop_x_percent > 0 or crop_y_percent > 0:
-            card_width, card_height = card_image.size
-            card_width_crop = math.floor(card_width / 2 * (crop_x_percent / 100))
-            card_height_crop = math.floor(card_height / 2 * (crop_y_percent / 100))
-
-            card_image = card_image.crop((
-                card_width_crop,
-                card_height_crop,
-                card_width - card_width_crop,
-                card_height - card_height_crop
+# Encoded image data with its width, height, mode and PDF filter
+EncodedImage = tuple[bytes, int, int, str, str]
+
+class PageEncoder(BaseModel):
+    """
+    Encodes page images for PDF image streams.
+    With a maximum size, lossy images are encoded at the highest quality that fits within it.
+    """
+    quality: int
+    codec: PageCodec = PageCodec.JPEG
+    subsampling: Subsampling = Subsampling.S444
+
+    # Filters of the PDF image streams of each codec
+    codec_filters: ClassVar[Dict[PageCodec, str]] = {
+        PageCodec.JPEG: 'DCTDecode',
+        PageCodec.FLATE: 'FlateDecode',
+        PageCodec.JPEG2000: 'JPXDecode'
+    }
+
+    # Pages with at most this many colors are flat artwork, which is smaller and sharper without loss
+    auto_max_colors: ClassVar[int] = 4096
+
+    # The lowest quality used to fit a page within the maximum size
+    min_quality: ClassVar[int] = 10
+
+    # The lowest quality used before JPEG colors are subsampled 4:2:0 to fit, which loses less detail than a lower quality
+    full_chroma_min_quality: ClassVar[int] = 50
+
+    def _encode_lossy(self, image: Image.Image, codec: PageCodec, quality: int, subsampling: Subsampling) -> bytes:
+        buffer = io.BytesIO()
+        if codec == PageCodec.JPEG2000:
+            # Quality is mapped to a target peak signal-to-noise ratio, from 20 dB to 45 dB
+            with trace_span('jpeg2000 encode', size=image.size, quality=quality):
+                image.save(buffer, format='JPEG2000', irreversible=True, quality_mode='dB', quality_layers=[20 + quality / 4])
+        else:
+            with trace_span('jpeg encode', size=image.size, quality=quality, subsampling=subsampling.value):
+                image.save(buffer, format='JPEG', quality=quality, subsampling=subsampling.value)
+
+        return buffer.getvalue()
+
+    def _fit_lossy(self, image: Image.Image, codec: PageCodec, subsampling: Subsampling, low: int, high: int, max_bytes: int) -> bytes | None:
+        """The image encoded at the highest quality from low to high that fits within the maximum size, if any does"""
+        image_data = None
+
+        # Search for the highest quality that fits, since the size grows with quality
+        while low <= high:
+            quality = (low + high) // 2
+            candidate = self._encode_lossy(image, codec, quality, subsampling)
+            if len(candidate) <= max_bytes:
+                image_data = candidate
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        return image_data
+
+    def encode(self, image: Image.Image, max_bytes: int | None = None) -> EncodedImage:
+        """
+        Encodes an image and returns its data, size, mode and PDF filter.
+        An image that cannot fit within the maximum size at all is kept at full quality.
+        """
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        codec = self.codec
+        if codec == PageCodec.AUTO:
+            with trace_span('count colors'):
+                codec = PageCodec.FLATE if image.getcolors(self.auto_max_colors) is not None else PageCodec.JPEG
+
+        if codec == PageCodec.FLATE:
+            with trace_span('flate encode', size=image.size):
+                image_data = zlib.compress(image.tobytes())
+
+            # Only an automatic choice falls back to a lossy codec to fit within the maximum size
+            if max_bytes is None or len(image_data) <= max_bytes or self.codec == PageCodec.FLATE:
+                return image_data, image.width, image.height, image.mode, self.codec_filters[codec]
+            codec = PageCodec.JPEG
+
+        image_data = self._encode_lossy(image, codec, self.quality, self.subsampling)
+        if max_bytes is not None and len(image_data) > max_bytes:
+            # Colors are subsampled before the quality is lowered far, and grayscale images have no colors to subsample
+            steps = [(self.subsampling, self.min_quality, self.quality - 1)]
+            if codec == PageCodec.JPEG and image.mode == 'RGB' and self.subsampling != Subsampling.S420:
+                steps = [(self.subsampling, self.full_chroma_min_quality, self.quality - 1), (Subsampling.S420, self.min_quality, self.quality)]
+
+            for subsampling, low, high in steps:
+                fitted_data = self._fit_lossy(image, codec, subsampling, low, high, max_bytes)
+                if fitted_data is not None:
+                    image_data = fitted_data
+                    break
+
+        return image_data, image.width, image.height, image.mode, self.codec_filters[codec]
+
+class SheetRenderContext(BaseModel):
+    """Everything a sheet render needs, so that sheets can be rendered in other processes"""
+    front_dir_path: str
+    double_sided_dir_path: str
+    registration_path: str
+    paper_size: PaperSize
+    card_size: CardSize
+    registration: Registration
+    crop: tuple[float, float]
+    ppi: int
+    extend_corners: int
+    back_offset: OffsetData | None
+    name: str | None
+    slot_plan: SlotPlan
+
+    # Previews decode and resize card images faster at a lower quality
+    resample_quality: ResampleQuality = ResampleQuality.HIGH
+
+    # Pages are composed and encoded in bands of this many rows when set, with the encoder and size budget of a page
+    band_height: int | None = None
+    band_encoder: PageEncoder | None = None
+    max_page_bytes: int | None = None
+
+class SheetSpec(BaseModel):
+    """The card images assigned to each slot of one sheet; skipped and empty slots are None"""
+    sheet_number: int
+    front_files: List[str | None]
+    back_files: List[str | None] | None = None
+
+    # Pages with the same key have identical content, apart from the sheet label
+    front_key: str | None = None
+    back_key: str | None = None
+
+class SheetLabel(BaseModel):
+    """The label of a sheet, positioned in page pixels at the top center of the text"""
+    text: str
+    x: float
+    y: float
+    font_size: float
+
+def plan_sheets(single_sided_files: List[str], double_sided_files: List[str], num_cards: int, skip_indices: List[int]) -> List[SheetSpec]:
+    sheets: List[SheetSpec] = []
+
+    def assign_slots(file_group: List[str]) -> List[str | None]:
+        slots = []
+        file_group_iterator = iter(file_group)
+        for i in range(num_cards):
+            if i in skip_indices:
+                slots.append(None)
+                continue
+
+            try:
+                slots.append(next(file_group_iterator))
+            except StopIteration:
+                break
+
+        return slots
+
+    # Single-sided sheets come first, followed by double-sided sheets
+    for files, double_sided in [(single_sided_files, False), (double_sided_files, True)]:
+        it = iter(files)
+        while True:
+            file_group = list(itertools.islice(it, num_cards - len(skip_indices)))
+            if not file_group:
+                break
+
+            slots = assign_slots(file_group)
+            sheets.append(SheetSpec(
+                sheet_number=len(sheets) + 1,
+                front_files=slots,
+                back_files=slots if double_sided else None
             ))
 
-        # Resize the image to normalize extend_corners
-        card_image = card_image.resize((math.floor(width * ppi_ratio), math.floor(height * ppi_ratio)))
+    return sheets
 
-        extend_corners_ppi = math.floor(extend_corners * ppi_ratio)
-        card_image = card_image.crop((extend_corners_ppi, extend_corners_ppi, card_image.width - extend_corners_ppi, card_image.height - extend_corners_ppi))
+def print_sheet_images(sheet: SheetSpec, num_image: int) -> int:
+    for file in sheet.front_files:
+        if file is None:
+            continue
 
-        draw_card_with_bleed(
-            card_image,
-            base_image,
-            (new_origin_x + extend_corners_ppi, new_origin_y + extend_corners_ppi, math.floor(width * ppi_ratio) - (2 * extend_corners_ppi), math.floor(height * ppi_ratio) - (2 * extend_corners_ppi)),
-            tuple(math.ceil(bleed * ppi_ratio) + extend_corners_ppi for bleed in print_bleed)
-        )
+        if sheet.back_files is None:
+            print(f'Image {num_image}: {file}')
+        else:
+            print(f'Image {num_image} (double-sided): {file}')
+        num_image = num_image + 1
+
+    return num_image
+
+class ImageHeader(BaseModel):
+    """The size of an image as displayed, after its EXIF orientation, read without decoding its pixels"""
+    path: str
+    file_size: int = 0
+    width: int = 0
+    height: int = 0
+    format: str | None = None
+    mode: str | None = None
+    error: str | None = None
+
+def read_image_header(path: str) -> ImageHeader:
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
 
-def add_front_back_pages(front_page: Image.Image, back_page: Image.Image, pages: List[Image.Image], page_width: int, page_height: int, ppi_ratio: float, template: str, only_fronts: bool, name: str):
-    # Add template version number to the back
-    draw = ImageDraw.Draw(front_page)
-    font = ImageFont.truetype(os.path.join(asset_directory, 'arial.ttf'), 40 * ppi_ratio)
+            # Only EXIF data that is read with the header is used, since some formats decode the image to find the rest
+            orientation = 1
+            if 'exif' in image.info:
+                exif = Image.Exif()
+                exif.load(image.info['exif'])
+                orientation = exif.get(ExifTags.Base.Orientation, 1)
 
-    # "Raw" specified location
-    num_sheet = len(pages) + 1
-    if not only_fronts:
-        num_sheet = int(len(pages) / 2) + 1
+            if orientation in (5, 6, 7, 8):
+                width, height = height, width
 
+            return ImageHeader(path=path, file_size=os.path.getsize(path), width=width, height=height, format=image.format, mode=image.mode)
+
+    except (OSError, SyntaxError, ValueError) as e:
+        return ImageHeader(path=path, error=str(e))
+
+def read_image_headers(paths: List[str]) -> Dict[str, ImageHeader]:
+    """Reads the headers of many images in parallel"""
+    unique_paths = list(dict.fromkeys(paths))
+    with ThreadPoolExecutor() as executor:
+        return dict(zip(unique_paths, executor.map(read_image_header, unique_paths)))
+
+# Rough throughput of rendering and encoding raster pages with one job, used to estimate builds
+estimated_seconds_per_source_megapixel = 0.025
+estimated_seconds_per_page_megapixel = 0.01
+estimated_bytes_per_page_megapixel = 50 * 1024
+
+def print_build_plan(context: SheetRenderContext, sheets: List[SheetSpec], back_card_image_path: str | None, only_fronts: bool, native_pdf: bool, output_images: bool, copies: int):
+    """
+    Prints the sheets that would be generated and problems with the card images, without rendering anything.
+    Only image headers are read, so corrupt pixel data is not detected and estimates assume every image is decoded once.
+    """
+    def card_image_paths(dir_path: str, files: List[str | None]) -> List[str]:
+        return [os.path.join(dir_path, file) for file in files if file is not None]
+
+    all_image_paths = [back_card_image_path] if back_card_image_path is not None else []
+    for sheet in sheets:
+        all_image_paths.extend(card_image_paths(context.front_dir_path, sheet.front_files))
+        if sheet.back_files is not None:
+            all_image_paths.extend(card_image_paths(context.double_sided_dir_path, sheet.back_files))
+
+    headers = read_image_headers(all_image_paths)
+
+    num_cards = 0
+    num_pages = 0
+    for sheet in sheets:
+        front_files = [file for file in sheet.front_files if file is not None]
+        num_cards += len(front_files)
+        num_pages += 1 if only_fronts else 2
+
+        double_sided = ' (double-sided)' if sheet.back_files is not None else ''
+        print(f'Sheet {sheet.sheet_number}{double_sided}: {", ".join(front_files)}')
+
+    print(f'{num_cards} cards on {len(sheets)} sheets, {num_pages * copies} pages')
+
+    unreadable = [header for header in headers.values() if header.error is not None]
+    if len(unreadable) > 0:
+        print(f'Cannot read {len(unreadable)} of {len(headers)} images:')
+        for header in unreadable:
+            print(f'  {header.path}: {header.error}')
+
+    # The effective ppi of an image is limited by the axis with the fewest pixels per inch of the card after cropping.
+    # The back card of single-sided sheets is drawn uncropped, unlike fronts and double-sided backs.
+    card_width_in = context.slot_plan.card_layout_size.width / 300
+    card_height_in = context.slot_plan.card_layout_size.height / 300
+    low_ppi = []
+    for header in headers.values():
+        if header.error is not None:
+            continue
+
+        crop_x_percent, crop_y_percent = (0, 0) if header.path == back_card_image_path else context.crop
+        effective_ppi = math.floor(min(
+            header.width * (1 - crop_x_percent / 100) / card_width_in,
+            header.height * (1 - crop_y_percent / 100) / card_height_in
+        ))
+        if effective_ppi < context.ppi:
+            low_ppi.append((header.path, effective_ppi))
+
+    if len(low_ppi) > 0:
+        print(f'{len(low_ppi)} images are below {context.ppi} PPI in their slot and will be upscaled:')
+        for path, effective_ppi in low_ppi:
+            print(f'  {path}: {effective_ppi} PPI')
+
+    if output_images:
+        return
+
+    readable = [header for header in headers.values() if header.error is None]
+    if native_pdf:
+        # Card images are embedded instead of rendered, and JPEG images that are not downsampled are embedded as is
+        card_megapixels = context.slot_plan.card_layout_size.width * context.slot_plan.card_layout_size.height * (context.ppi / 300) ** 2 / 1_000_000
+        estimated_size = os.path.getsize(context.registration_path)
+        for header in readable:
+            megapixels = header.width * header.height / 1_000_000
+            if header.format == 'JPEG' and megapixels <= card_megapixels:
+                estimated_size += header.file_size
+            else:
+                estimated_size += min(megapixels, card_megapixels) * estimated_bytes_per_page_megapixel
+
+        print(f'Estimated PDF size: {estimated_size / (1024 * 1024):.1f} MB')
+        return
+
+    source_megapixels = sum(header.width * header.height for header in readable) / 1_000_000
+    page_width, page_height = context.slot_plan.page_size
+    page_megapixels = num_pages * page_width * page_height / 1_000_000
+
+    estimated_seconds = source_megapixels * estimated_seconds_per_source_megapixel + page_megapixels * estimated_seconds_per_page_megapixel
+    estimated_size = page_megapixels * estimated_bytes_per_page_megapixel * copies
+    print(f'Estimated render time with one job: {estimated_seconds:.0f}s')
+    print(f'Estimated PDF size: {estimated_size / (1024 * 1024):.1f} MB')
+
+def load_registration_page(registration_path: str, ppi_ratio: float, resample_quality: ResampleQuality = ResampleQuality.HIGH) -> Image.Image:
+    with Image.open(registration_path) as reg_im:
+        size = (math.floor(reg_im.width * ppi_ratio), math.floor(reg_im.height * ppi_ratio))
+        if resample_quality == ResampleQuality.DRAFT:
+            reg_im.draft(None, size)
+
+        resample, reducing_gap = resample_settings[resample_quality]
+        return reg_im.resize(size, resample, reducing_gap=reducing_gap)
+
+def get_back_offset(back_offset: OffsetData | None, ppi: int) -> tuple[float, float]:
+    """The offset of back pages in page pixels, since offsets are measured at 300 ppi"""
+    if back_offset is None:
+        return (0, 0)
+
+    return (back_offset.x_offset * ppi / 300, back_offset.y_offset * ppi / 300)
+
+def load_registration_pages(
+    registration_path: str,
+    ppi: int,
+    back_offset: OffsetData | None,
+    resample_quality: ResampleQuality = ResampleQuality.HIGH,
+    tile_store: TileStore | None = None
+) -> tuple[Image.Image, Image.Image]:
+    """
+    Loads the registration page for front pages and the registration page for back pages, shifted by the offset.
+    Scaled pages are kept in the tile store, if one is provided, so later runs skip decoding and resizing the full page.
+    """
+    offset = get_back_offset(back_offset, ppi)
+    if tile_store is None:
+        return scale_registration_pages(registration_path, ppi, offset, resample_quality)
+
+    key = ('registration', hash_file(registration_path), ppi, offset, resample_quality.value)
+    front_page = tile_store.load(key + ('front',))
+    back_page = front_page if offset == (0, 0) else tile_store.load(key + ('back',))
+    if front_page is not None and back_page is not None:
+        return front_page, back_page
+
+    front_page, back_page = scale_registration_pages(registration_path, ppi, offset, resample_quality)
+    tile_store.save(key + ('front',), front_page)
+    if back_page is not front_page:
+        tile_store.save(key + ('back',), back_page)
+
+    return front_page, back_page
+
+def scale_registration_pages(registration_path: str, ppi: int, offset: tuple[float, float], resample_quality: ResampleQuality) -> tuple[Image.Image, Image.Image]:
+    front_page = load_registration_page(registration_path, ppi / 300, resample_quality)
+
+    offset_x, offset_y = offset
+    if offset_x == 0 and offset_y == 0:
+        return front_page, front_page
+
+    # Like cards, the fraction of a pixel is applied while resizing and whole pixels while pasting
+    whole_x = math.floor(offset_x)
+    whole_y = math.floor(offset_y)
+    shifted_page = front_page
+    if offset_x != whole_x or offset_y != whole_y:
+        with Image.open(registration_path) as reg_im:
+            if resample_quality == ResampleQuality.DRAFT:
+                reg_im.draft(None, front_page.size)
+            shifted_page = resize_with_shift(reg_im, front_page.size, (offset_x - whole_x, offset_y - whole_y), resample_quality=resample_quality)
+
+    # Content shifted off the page is dropped instead of wrapping around to the other side
+    back_page = Image.new(front_page.mode, front_page.size, 'white')
+    back_page.paste(shifted_page, (whole_x, whole_y))
+
+    return front_page, back_page
+
+class RegistrationBands:
+    """
+    Scales horizontal bands of the registration pages on demand, so the full pages are never held at a high PPI.
+    Bands match the rows of the pages from load_registration_pages, including the offset of back pages.
+    """
+
+    def __init__(self, registration_path: str, ppi: int, back_offset: OffsetData | None, resample_quality: ResampleQuality = ResampleQuality.HIGH):
+        with Image.open(registration_path) as reg_im:
+            self.source = reg_im.copy()
+
+        ppi_ratio = ppi / 300
+        self.page_size = (math.floor(self.source.width * ppi_ratio), math.floor(self.source.height * ppi_ratio))
+        self.offset = get_back_offset(back_offset, ppi)
+        self.resample_quality = resample_quality
+
+    def _scale_rows(self, top: int, bottom: int, shift: tuple[float, float] = (0, 0)) -> Image.Image:
+        """Scales the source to rows top to bottom of the page, in one resample with the shift"""
+        page_width, page_height = self.page_size
+        scale_y = self.source.height / page_height
+        box = (0, top * scale_y, self.source.width, bottom * scale_y)
+
+        return resize_with_shift(self.source, (page_width, bottom - top), shift, box, self.resample_quality)
+
+    def draw_band(self, top: int, height: int, flip: bool) -> Image.Image:
+        """Draws rows top to top + height of the registration page for front pages, or back pages when flipped"""
+        offset_x, offset_y = self.offset if flip else (0, 0)
+        if offset_x == 0 and offset_y == 0:
+            return self._scale_rows(top, top + height)
+
+        # The rows of the shifted page that land in the band, which are pasted at the whole-pixel offset as for full pages
+        whole_x = math.floor(offset_x)
+        whole_y = math.floor(offset_y)
+        band = Image.new(self.source.mode, (self.page_size[0], height), 'white')
+        first_row = max(0, top - whole_y)
+        last_row = min(self.page_size[1], top + height - whole_y)
+        if first_row < last_row:
+            band.paste(self._scale_rows(first_row, last_row, (offset_x - whole_x, offset_y - whole_y)), (whole_x, first_row + whole_y - top))
+
+        return band
+
+def load_registration(context: SheetRenderContext, tile_store: TileStore | None = None) -> tuple[Image.Image, Image.Image] | RegistrationBands:
+    """Loads the registration pages of a render, or their bands when pages are composed in bands"""
+    if context.band_height is not None:
+        return RegistrationBands(context.registration_path, context.ppi, context.back_offset, context.resample_quality)
+
+    return load_registration_pages(context.registration_path, context.ppi, context.back_offset, context.resample_quality, tile_store)
+
+def draw_page(
+    context: SheetRenderContext,
+    registration: tuple[Image.Image, Image.Image] | RegistrationBands,
+    card_image_paths: List[str | None],
+    crop: tuple[float, float],
+    flip: bool,
+    tile_cache: CardTileCache
+) -> Image.Image | List[EncodedImage]:
+    """
+    Composes a front page, or a back page shifted by the back offset when flipped.
+    When pages are composed in bands, each band is encoded as soon as it is composed and the encoded bands are returned.
+    """
+    offset = get_back_offset(context.back_offset, context.ppi) if flip else (0, 0)
+    if context.band_height is None:
+        page = registration[1 if flip else 0].copy()
+        draw_card_layout(card_image_paths, page, context.slot_plan, crop, flip, tile_cache, offset, context.resample_quality)
+        return page
+
+    bands = []
+    page_height = context.slot_plan.page_size[1]
+    for band in draw_card_layout_bands(
+        card_image_paths,
+        lambda top, height: registration.draw_band(top, height, flip),
+        context.slot_plan,
+        context.band_height,
+        crop,
+        flip,
+        tile_cache,
+        offset,
+        context.resample_quality
+    ):
+        # The size budget of a page is shared by its bands by their height
+        max_band_bytes = None
+        if context.max_page_bytes is not None:
+            max_band_bytes = math.floor(context.max_page_bytes * band.height / page_height)
+
+        bands.append(context.band_encoder.encode(band, max_band_bytes))
+
+    return bands
+
+def make_sheet_label(num_sheet: int, page_width: int, page_height: int, ppi_ratio: float, template: str, name: str | None) -> SheetLabel:
+    # Add template version number to the front
     label = f'sheet: {num_sheet}, template: {template}'
     if name is not None:
         label = f'name: {name}, {label}'
 
-    draw.text((math.floor((page_width / 2) * ppi_ratio), math.floor((page_height - 140) * ppi_ratio)), label, fill = (0, 0, 0), anchor="ma", font=font)
+    return SheetLabel(
+        text=label,
+        x=math.floor((page_width / 2) * ppi_ratio),
+        y=math.floor((page_height - 140) * ppi_ratio),
+        font_size=40 * ppi_ratio
+    )
 
-    # Add a back page for every front page template
-    pages.append(front_page)
-    if not only_fronts:
-        pages.append(back_page)
+def draw_sheet_label(front_page: Image.Image, label: SheetLabel):
+    with trace_span('label'):
+        draw = ImageDraw.Draw(front_page)
+        font = load_label_font(label.font_size)
+
+        draw.text((label.x, label.y), label.text, fill = (0, 0, 0), anchor="ma", font=font)
+
+def make_page_key(render_key: str, side: str, image_hashes: List[str | None]) -> str:
+    return hashlib.sha256(repr((render_key, side, image_hashes)).encode()).hexdigest()
+
+def render_sheet(context: SheetRenderContext, sheet: SheetSpec, registration: tuple[Image.Image, Image.Image] | RegistrationBands, tile_cache: CardTileCache, render_front: bool = True, render_back: bool = True) -> tuple[Image.Image | List[EncodedImage] | None, Image.Image | List[EncodedImage] | None]:
+    """
+    Composes the front page of a sheet and, for double-sided sheets, its back page.
+    Single-sided sheets share a back page that is composed once by the caller.
+    Pages that are not rendered, because an identical page was already rendered, are None.
+    Back pages are shifted by the back offset as their cards are placed.
+    When pages are composed in bands, each page is a list of encoded bands.
+    """
+    def card_image_paths(dir_path: str, files: List[str | None]) -> List[str | None]:
+        return [None if file is None else os.path.join(dir_path, file) for file in files]
+
+    front_page = None
+    if render_front:
+        with trace_span('front page', sheet=sheet.sheet_number):
+            front_page = draw_page(context, registration, card_image_paths(context.front_dir_path, sheet.front_files), context.crop, False, tile_cache)
+
+    back_page = None
+    if sheet.back_files is not None and render_back:
+        with trace_span('back page', sheet=sheet.sheet_number):
+            back_page = draw_page(context, registration, card_image_paths(context.double_sided_dir_path, sheet.back_files), context.crop, True, tile_cache)
+
+    return front_page, back_page
+
+# Per-process state for rendering sheets in a process pool
+_worker_context: SheetRenderContext | None = None
+_worker_registration: tuple[Image.Image, Image.Image] | RegistrationBands | None = None
+_worker_tile_cache: CardTileCache | None = None
+
+def _init_sheet_worker(context: SheetRenderContext, tile_cache: CardTileCache, trace: bool):
+    global _worker_context, _worker_registration, _worker_tile_cache
+
+    if trace:
+        start_tracing()
+
+    _worker_context = context
+    _worker_registration = load_registration(context, tile_cache.tile_store)
+    _worker_tile_cache = tile_cache
+
+def _render_sheet_in_worker(sheet: SheetSpec, render_front: bool, render_back: bool) -> tuple[tuple[Image.Image | List[EncodedImage] | None, Image.Image | List[EncodedImage] | None], List[dict]]:
+    pages = render_sheet(_worker_context, sheet, _worker_registration, _worker_tile_cache, render_front, render_back)
+
+    # Spans recorded in the worker are sent back with the pages
+    return pages, [] if _tracer is None else _tracer.drain()
+
+def render_sheets(context: SheetRenderContext, sheets: List[SheetSpec], registration: tuple[Image.Image, Image.Image] | RegistrationBands, tile_cache: CardTileCache, jobs: int, reuse_fronts: bool = True, cached_keys: set | None = None):
+    """
+    Yields the rendered pages of every sheet in sheet order.
+    A page whose key matches an earlier or cached page is not rendered again and is yielded as None.
+    With more than one job, sheets are rendered in a process pool with a bounded number of sheets in flight.
+    """
+    rendered_keys = set(cached_keys or ())
+
+    def pages_to_render(sheet: SheetSpec) -> tuple[bool, bool]:
+        render_front = not (reuse_fronts and sheet.front_key is not None and sheet.front_key in rendered_keys)
+        render_back = sheet.back_key is None or sheet.back_key not in rendered_keys
+        rendered_keys.update({sheet.front_key, sheet.back_key} - {None})
+
+        return render_front, render_back
+
+    if jobs <= 1 or len(sheets) <= 1:
+        for sheet in sheets:
+            yield sheet, render_sheet(context, sheet, registration, tile_cache, *pages_to_render(sheet))
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_sheet_worker, initargs=(context, tile_cache, _tracer is not None)) as executor:
+        sheet_iterator = iter(sheets)
+        in_flight = deque()
+
+        # Keep a couple of sheets queued per worker so workers never idle while pages are written
+        for sheet in itertools.islice(sheet_iterator, jobs * 2):
+            in_flight.append((sheet, executor.submit(_render_sheet_in_worker, sheet, *pages_to_render(sheet))))
+
+        while in_flight:
+            sheet, future = in_flight.popleft()
+            pages, events = future.result()
+            if _tracer is not None:
+                _tracer.events.extend(events)
+
+            next_sheet = next(sheet_iterator, None)
+            if next_sheet is not None:
+                in_flight.append((next_sheet, executor.submit(_render_sheet_in_worker, next_sheet, *pages_to_render(next_sheet))))
+
+            yield sheet, pages
+
+# Bump when the rendering of pages changes, so pages of previous builds are not reused
+build_manifest_version = 1
+
+class PageImageRecord(BaseModel):
+    """The location and format of the encoded image of a page in a PDF"""
+    offset: int
+    length: int
+    width: int
+    height: int
+    mode: str
+    image_filter: str = 'DCTDecode'
+
+class BuildManifest(BaseModel):
+    """
+    Describes the inputs of a generated PDF, so a rerun can skip an unchanged build
+    and reuse the encoded images of unchanged pages.
+    """
+    version: int = build_manifest_version
+    build_key: str
+    output_size: int
+    output_mtime_ns: int
+    pages: Dict[str, PageImageRecord] = {}
+
+def get_preview_path(output_path: str) -> str:
+    root, extension = os.path.splitext(output_path)
+    return f'{root}.preview{extension}'
+
+def get_build_manifest_path(output_path: str) -> str:
+    return f'{output_path}.manifest.json'
+
+def load_build_manifest(output_path: str) -> BuildManifest | None:
+    """Load the manifest of a previous build, if it still describes the file at the output path"""
+    manifest_path = get_build_manifest_path(output_path)
+    if not os.path.exists(manifest_path) or not os.path.exists(output_path):
+        return None
+
+    with open(manifest_path, 'r') as manifest_file:
+        try:
+            manifest = BuildManifest(**json.load(manifest_file))
+        except (json.JSONDecodeError, ValueError) as e:
+            print(f'Ignoring invalid build manifest "{manifest_path}": {e}')
+            return None
+
+    output_stat = os.stat(output_path)
+    if manifest.version != build_manifest_version:
+        return None
+    if manifest.output_size != output_stat.st_size or manifest.output_mtime_ns != output_stat.st_mtime_ns:
+        return None
+
+    return manifest
+
+def save_build_manifest(output_path: str, build_key: str, pages: Dict[str, PageImageRecord]):
+    output_stat = os.stat(output_path)
+    manifest = BuildManifest(build_key=build_key, output_size=output_stat.st_size, output_mtime_ns=output_stat.st_mtime_ns, pages=pages)
+
+    with open(get_build_manifest_path(output_path), 'w') as manifest_file:
+        manifest_file.write(manifest.model_dump_json())
+
+class PdfWriter:
+    """
+    Writes image pages to a PDF as they are added instead of holding every page in memory.
+
+    After each page, an incremental update (new page tree, cross-reference section and trailer)
+    is appended so the file on disk is always a valid PDF containing every page written so far.
+
+    Identical images, content streams and fonts are embedded once and shared by every page that uses them.
+
+    Page images are encoded in a thread pool while the next pages are composed, and pages are written in order
+    as their images finish encoding.
+
+    Images are encoded with the codec of the PDF. With a maximum page size, lossy page images are encoded
+    at the highest quality that fits within it.
+
+    Pages composed in bands are added already encoded, as a stack of band images.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        resolution: float,
+        quality: int,
+        encode_jobs: int = 1,
+        codec: PageCodec = PageCodec.JPEG,
+        subsampling: Subsampling = Subsampling.S444,
+        max_page_bytes: int | None = None
+    ):
+        self.path = path
+        self.resolution = resolution
+        self.page_encoder = PageEncoder(quality=quality, codec=codec, subsampling=subsampling)
+        self.encode_jobs = encode_jobs
+        self.max_page_bytes = max_page_bytes
+
+        self.page_count = 0
+        self._file = None
+        self._next_object_id = 3
+        self._page_ids: List[int] = []
+        self._page_bodies: List[bytes] = []
+        self._pending_offsets: Dict[int, int] = {}
+        self._last_xref_offset = None
+
+        # Object ids of already embedded objects, by content hash or page key
+        self._shared_ids: Dict[str, int] = {}
+        self._page_images: Dict[str, tuple[int, int, int]] = {}
+        self._banded_pages: Dict[str, List[tuple[int, int, int]]] = {}
+        self._image_streams: Dict[int, PageImageRecord] = {}
+
+        # Pages waiting for their image to be encoded, and the keys of those images
+        self._encode_pool = None
+        self._pending_pages = deque()
+        self._encoding_keys: set[str] = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # The PDF is incomplete anyway, so pages that are still being encoded are dropped
+            self._pending_pages.clear()
+
+        self.close()
+
+    def _open(self):
+        self._file = open(self.path, 'wb')
+
+        # JPEG 2000 images need PDF 1.5
+        version = b'1.5' if self.page_encoder.codec == PageCodec.JPEG2000 else b'1.4'
+        self._file.write(b'%PDF-' + version + b'\n%\xe2\xe3\xcf\xd3\n')
+
+        # Object 1 is the catalog and object 2 is the page tree, which is rewritten on every update
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+
+    def _reserve_object_id(self) -> int:
+        object_id = self._next_object_id
+        self._next_object_id += 1
+        return object_id
+
+    def _write_object(self, object_id: int, body: bytes, stream: bytes | None = None) -> int | None:
+        """Writes an object and returns the file offset of its stream data, if it has any"""
+        self._pending_offsets[object_id] = self._file.tell()
+        self._file.write(f'{object_id} 0 obj\n'.encode())
+        self._file.write(body)
+
+        stream_offset = None
+        if stream is not None:
+            self._file.write(b'\nstream\n')
+            stream_offset = self._file.tell()
+            self._file.write(stream)
+            self._file.write(b'\nendstream')
+        self._file.write(b'\nendobj\n')
+
+        return stream_offset
+
+    def _write_update(self):
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self._page_ids)
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>'.encode())
+
+        xref_offset = self._file.tell()
+        self._file.write(b'xref\n')
+
+        if self._last_xref_offset is None:
+            self._pending_offsets[0] = None
+
+        # Group the updated objects into contiguous subsections
+        object_ids = sorted(self._pending_offsets)
+        for _, group in itertools.groupby(enumerate(object_ids), lambda pair: pair[1] - pair[0]):
+            group_ids = [object_id for _, object_id in group]
+            self._file.write(f'{group_ids[0]} {len(group_ids)}\n'.encode())
+            for object_id in group_ids:
+                offset = self._pending_offsets[object_id]
+                if offset is None:
+                    self._file.write(b'0000000000 65535 f\r\n')
+                else:
+                    self._file.write(f'{offset:010} 00000 n\r\n'.encode())
+
+        trailer = f'/Size {self._next_object_id} /Root 1 0 R'
+        if self._last_xref_offset is not None:
+            trailer += f' /Prev {self._last_xref_offset}'
+        self._file.write(f'trailer\n<< {trailer} >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode())
+        self._file.flush()
+
+        self._pending_offsets = {}
+        self._last_xref_offset = xref_offset
+
+    def add_encoded_image(self, image_data: bytes, width: int, height: int, mode: str, image_filter: str = 'DCTDecode') -> int:
+        """Embeds already encoded image data, JPEG by default, as an image object and returns its object id"""
+        if self._file is None:
+            self._open()
+
+        shared_key = 'image:' + hashlib.sha256(image_data).hexdigest()
+        if shared_key in self._shared_ids:
+            return self._shared_ids[shared_key]
+
+        color_space = '/DeviceGray' if mode == 'L' else '/DeviceRGB'
+
+        image_id = self._reserve_object_id()
+        stream_offset = self._write_object(
+            image_id,
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace {color_space} /BitsPerComponent 8 /Filter /{image_filter} /Length {len(image_data)} >>'.encode(),
+            image_data
+        )
+        self._shared_ids[shared_key] = image_id
+        self._image_streams[image_id] = PageImageRecord(offset=stream_offset, length=len(image_data), width=width, height=height, mode=mode, image_filter=image_filter)
+
+        return image_id
+
+    def add_image(self, image: Image.Image) -> int:
+        """Encodes an image with the codec of the PDF and returns its object id"""
+        return self.add_encoded_image(*self.page_encoder.encode(image))
+
+    def add_lossless_image(self, image: Image.Image, interpolate: bool = True) -> int:
+        """Embeds an image without loss using Flate compression and returns its object id"""
+        if self._file is None:
+            self._open()
+
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        color_space = '/DeviceGray' if image.mode == 'L' else '/DeviceRGB'
+        with trace_span('flate encode', size=image.size):
+            image_data = zlib.compress(image.tobytes())
+
+        image_id = self._reserve_object_id()
+        self._write_object(
+            image_id,
+            f'<< /Type /XObject /Subtype /Image /Width {image.width} /Height {image.height} /ColorSpace {color_space} /BitsPerComponent 8 /Interpolate {"true" if interpolate else "false"} /Filter /FlateDecode /Length {len(image_data)} >>'.encode(),
+            image_data
+        )
+
+        return image_id
+
+    def add_font(self, base_font: str) -> int:
+        """Adds one of the standard 14 PDF fonts and returns its object id"""
+        if self._file is None:
+            self._open()
+
+        shared_key = 'font:' + base_font
+        if shared_key in self._shared_ids:
+            return self._shared_ids[shared_key]
+
+        font_id = self._reserve_object_id()
+        self._write_object(font_id, f'<< /Type /Font /Subtype /Type1 /BaseFont /{base_font} /Encoding /WinAnsiEncoding >>'.encode())
+        self._shared_ids[shared_key] = font_id
+
+        return font_id
+
+    def add_content(self, content: bytes) -> int:
+        """Adds a page content stream and returns its object id, so pages with identical content can share it"""
+        if self._file is None:
+            self._open()
+
+        shared_key = 'content:' + hashlib.sha256(content).hexdigest()
+        if shared_key in self._shared_ids:
+            return self._shared_ids[shared_key]
+
+        content_id = self._reserve_object_id()
+        compressed_content = zlib.compress(content)
+        self._write_object(content_id, f'<< /Length {len(compressed_content)} /Filter /FlateDecode >>'.encode(), compressed_content)
+        self._shared_ids[shared_key] = content_id
+
+        return content_id
+
+    def add_page_object(self, content_id: int, page_width: float, page_height: float, xobjects: Dict[str, int], fonts: Dict[str, int] | None = None):
+        """Adds a page drawing the given content stream, in points, with the named image and font resources"""
+        resources = '/XObject << ' + ' '.join(f'/{name} {object_id} 0 R' for name, object_id in xobjects.items()) + ' >>'
+        if fonts:
+            resources += ' /Font << ' + ' '.join(f'/{name} {object_id} 0 R' for name, object_id in fonts.items()) + ' >>'
+
+        page_body = f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}] /Resources << {resources} >> /Contents {content_id} 0 R >>'.encode()
+
+        page_id = self._reserve_object_id()
+        self._write_object(page_id, page_body)
+        self._page_ids.append(page_id)
+        self._page_bodies.append(page_body)
+
+        self._write_update()
+        self.page_count += 1
+
+    def add_page(self, image: Image.Image | None, key: str | None = None, label: SheetLabel | None = None):
+        """
+        Adds a page that shows a single full-page image, with an optional text label.
+        Pages with the same key share one image, which is only encoded for the first of them,
+        so image can be None for a key that was already added.
+        """
+        encoding = None
+        if key is None or (key not in self._page_images and key not in self._encoding_keys):
+            if self._encode_pool is None:
+                self._encode_pool = ThreadPoolExecutor(max_workers=self.encode_jobs)
+
+            encoding = self._encode_pool.submit(self.page_encoder.encode, image, self.max_page_bytes)
+            if key is not None:
+                self._encoding_keys.add(key)
+
+        self._pending_pages.append((encoding, key, label))
+
+        # Bound the number of composed pages held in memory while they are encoded
+        while len(self._pending_pages) > 2 * self.encode_jobs:
+            self._write_pending_page()
+
+    def _check_page_size(self, page_bytes: int):
+        """Reports the next page when its images could not be encoded within the maximum size"""
+        if self.max_page_bytes is not None and page_bytes > self.max_page_bytes:
+            print(f'Page {self.page_count + 1} is {page_bytes / (1024 * 1024):.3g} MB, over the maximum of {self.max_page_bytes / (1024 * 1024):.3g} MB per page')
+
+    def _write_pending_page(self):
+        encoding, key, label = self._pending_pages.popleft()
+        if encoding is None:
+            image_id, width, height = self._page_images[key]
+        else:
+            image_data, width, height, mode, image_filter = encoding.result()
+            self._check_page_size(len(image_data))
+            image_id = self.add_encoded_image(image_data, width, height, mode, image_filter)
+            if key is not None:
+                self._page_images[key] = (image_id, width, height)
+                self._encoding_keys.discard(key)
+
+        page_width = width * 72 / self.resolution
+        page_height = height * 72 / self.resolution
+        self._add_image_page(f'q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q', width, height, {'Im0': image_id}, label)
+
+    def _add_image_page(self, content: str, width: int, height: int, xobjects: Dict[str, int], label: SheetLabel | None):
+        """Adds a page of the given size in pixels that draws the content and then the label"""
+        fonts = None
+        if label is not None:
+            content += '\n' + pdf_label_operators(label, height, 72 / self.resolution)
+            fonts = {'F1': self.add_font('Helvetica')}
+
+        self.add_page_object(self.add_content(content.encode()), width * 72 / self.resolution, height * 72 / self.resolution, xobjects, fonts)
+
+    def add_banded_page(self, bands: List[EncodedImage] | None, key: str | None = None, label: SheetLabel | None = None):
+        """
+        Adds a page that stacks already encoded horizontal bands from the top, with an optional text label.
+        Pages with the same key share their band images, so bands can be None for a key that was already added.
+        """
+        # Pages are written in the order they are added
+        self.flush()
+
+        if bands is None:
+            band_images = self._banded_pages[key]
+        else:
+            self._check_page_size(sum(len(band[0]) for band in bands))
+            band_images = [(self.add_encoded_image(*band), band[1], band[2]) for band in bands]
+            if key is not None:
+                self._banded_pages[key] = band_images
+
+        # Bands are placed in pixels from the bottom of the page
+        width = band_images[0][1]
+        height = sum(band_height for _, _, band_height in band_images)
+        scale = 72 / self.resolution
+        operators = [f'q {scale:.6f} 0 0 {scale:.6f} 0 0 cm']
+        band_bottom = height
+        for i, (_, band_width, band_height) in enumerate(band_images):
+            band_bottom -= band_height
+            operators.append(f'q {band_width} 0 0 {band_height} 0 {band_bottom} cm /Im{i} Do Q')
+        operators.append('Q')
+
+        self._add_image_page('\n'.join(operators), width, height, {f'Im{i}': image_id for i, (image_id, _, _) in enumerate(band_images)}, label)
+
+    def add_page_image(self, key: str, image_data: bytes, width: int, height: int, mode: str, image_filter: str = 'DCTDecode'):
+        """Registers already encoded image data as the image of pages with the given key"""
+        self._page_images[key] = (self.add_encoded_image(image_data, width, height, mode, image_filter), width, height)
+
+    def has_page_image(self, key: str) -> bool:
+        return key in self._page_images or key in self._encoding_keys
+
+    def flush(self):
+        """Waits for every added page to be encoded and written"""
+        while self._pending_pages:
+            self._write_pending_page()
+
+    def page_image_records(self) -> Dict[str, 'PageImageRecord']:
+        """The location of the encoded image of every keyed page in the file"""
+        self.flush()
+        return {key: self._image_streams[image_id] for key, (image_id, _, _) in self._page_images.items()}
+
+    def repeat_pages(self, copies: int):
+        """Appends copies - 1 more copies of every page so far, which reference the objects of the original pages"""
+        self.flush()
+        if copies <= 1 or not self._page_bodies:
+            return
+
+        page_bodies = list(self._page_bodies)
+        for _ in range(copies - 1):
+            for page_body in page_bodies:
+                page_id = self._reserve_object_id()
+                self._write_object(page_id, page_body)
+                self._page_ids.append(page_id)
+                self._page_bodies.append(page_body)
+                self.page_count += 1
+
+        self._write_update()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._encode_pool is not None:
+                self._encode_pool.shutdown(cancel_futures=True)
+                self._encode_pool = None
+
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class ImageDirectoryWriter:
+    """
+    Saves each page as a numbered PNG or TIFF image, encoded in a thread pool as pages are added.
+    Pages with the same key are encoded once and copied after that.
+    """
+
+    def __init__(self, directory_path: str, resolution: float, quality: int, image_format: ImageFormat = ImageFormat.PNG, compress_level: int = 6, encode_jobs: int = 1):
+        self.directory_path = directory_path
+        self.resolution = resolution
+        self.quality = quality
+        self.image_format = ImageFormat(image_format)
+        self.compress_level = compress_level
+        self.encode_jobs = encode_jobs
+
+        self.page_count = 0
+        self._page_paths: Dict[str, str] = {}
+        self._encode_pool = None
+        self._encodings: Dict[str, Future] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Pages that are not saved yet are dropped instead of waiting for them
+            self._encodings.clear()
+
+        self.close()
+
+    def _page_path(self, page_number: int) -> str:
+        return os.path.join(self.directory_path, f'page{page_number}.{self.image_format.value}')
+
+    def _save_image(self, image: Image.Image, page_path: str):
+        dpi = (self.resolution, self.resolution)
+        if self.image_format == ImageFormat.TIFF:
+            # LZW is lossless and read by all print and layout software
+            with trace_span('tiff encode', size=image.size):
+                image.save(page_path, dpi=dpi, compression='tiff_lzw')
+        else:
+            with trace_span('png encode', size=image.size):
+                image.save(page_path, dpi=dpi, compress_level=self.compress_level)
+
+    def add_page(self, image: Image.Image | None, key: str | None = None, label: SheetLabel | None = None):
+        self.page_count += 1
+        page_path = self._page_path(self.page_count)
+
+        if key is not None and key in self._page_paths:
+            source_path = self._page_paths[key]
+            self._encodings[source_path].result()
+            shutil.copyfile(source_path, page_path)
+            return
+
+        # Labels are drawn into the image, so labelled pages are never shared
+        if label is not None:
+            draw_sheet_label(image, label)
+        elif key is not None:
+            self._page_paths[key] = page_path
+
+        if self._encode_pool is None:
+            self._encode_pool = ThreadPoolExecutor(max_workers=self.encode_jobs)
+        self._encodings[page_path] = self._encode_pool.submit(self._save_image, image, page_path)
+
+        # Bound the number of composed pages held in memory while they are encoded
+        pending = [encoding for encoding in self._encodings.values() if not encoding.done()]
+        for encoding in pending[:len(pending) - 2 * self.encode_jobs]:
+            encoding.result()
+
+    def flush(self):
+        """Waits for every added page to be saved"""
+        for encoding in self._encodings.values():
+            encoding.result()
+
+    def repeat_pages(self, copies: int):
+        self.flush()
+
+        page_count = self.page_count
+        for _ in range(copies - 1):
+            for page_number in range(1, page_count + 1):
+                self.page_count += 1
+                shutil.copyfile(self._page_path(page_number), self._page_path(self.page_count))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._encode_pool is not None:
+                self._encode_pool.shutdown(cancel_futures=True)
+                self._encode_pool = None
+
+class NativeCardImage(BaseModel):
+    """A card image embedded in a PDF, with the region shown in its slot and the edges used for print bleed"""
+    image_id: int
+    width: int
+    height: int
+    box: tuple[float, float, float, float]
+    left_strip_id: int
+    right_strip_id: int
+    top_strip_id: int
+    bottom_strip_id: int
+    corner_colors: List[tuple[int, int, int]]
+
+def pdf_escape_text(text: str) -> str:
+    escaped = ''
+    for byte in text.encode('cp1252', errors='replace'):
+        if byte in b'()\\':
+            escaped += '\\' + chr(byte)
+        elif byte < 32 or byte > 126:
+            escaped += f'\\{byte:03o}'
+        else:
+            escaped += chr(byte)
+
+    return escaped
+
+@functools.lru_cache(maxsize=None)
+def load_label_font(font_size: float) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(os.path.join(asset_directory, 'arial.ttf'), font_size)
+
+def pdf_label_operators(label: SheetLabel, page_height: float, scale: float) -> str:
+    """PDF operators that draw a sheet label with font /F1, where scale converts page pixels to points"""
+    # Helvetica shares its metrics with the Arial font used for rendered labels
+    font = load_label_font(label.font_size)
+    ascent, _ = font.getmetrics()
+    x = label.x - font.getlength(label.text) / 2
+    baseline = page_height - label.y - ascent
+
+    return f'BT 0 0 0 rg /F1 {label.font_size * scale:.4f} Tf {x * scale:.4f} {baseline * scale:.4f} Td ({pdf_escape_text(label.text)}) Tj ET\n'
+
+def pdf_image_region(name: str, image_size: tuple[int, int], box: tuple[float, float, float, float], rect: tuple[float, float, float, float]) -> str:
+    """PDF operators that draw the box region of an image (in pixels) into a rectangle (in points), clipped to the rectangle"""
+    image_width, image_height = image_size
+    x0, y0, x1, y1 = box
+    rect_x, rect_y, rect_width, rect_height = rect
+
+    scale_x = rect_width / (x1 - x0)
+    scale_y = rect_height / (y1 - y0)
+    translate_x = rect_x - x0 * scale_x
+    translate_y = rect_y - (image_height - y1) * scale_y
+
+    return f'q {rect_x:.4f} {rect_y:.4f} {rect_width:.4f} {rect_height:.4f} re W n {image_width * scale_x:.4f} 0 0 {image_height * scale_y:.4f} {translate_x:.4f} {translate_y:.4f} cm /{name} Do Q\n'
+
+class NativeSheetWriter:
+    """
+    Writes sheets as PDF pages that place the registration page and each card as separate images,
+    instead of rendering every sheet to a full-page bitmap.
+
+    The registration image is embedded once and shared by every page. Cards are scaled, rotated and cropped
+    with PDF transforms and clipping, and print bleed is drawn by stretching one-pixel edge strips of each card.
+    JPEG card images that do not need to be downsampled are embedded without being re-encoded.
+    """
+
+    # Points per layout pixel, since layouts are based on 300 ppi
+    scale = 72 / 300
+
+    # Bleed strips slightly overlap the card so no seam is visible between them
+    strip_overlap = 0.25
+
+    def __init__(self, writer: PdfWriter, context: SheetRenderContext, tile_cache: CardTileCache, back_card_image_path: str | None, skip_indices: List[int], only_fronts: bool):
+        self.writer = writer
+        self.context = context
+        self.tile_cache = tile_cache
+        self.only_fronts = only_fronts
+
+        self.card_images: Dict[tuple, NativeCardImage] = {}
+
+        # Embed the registration image as is
+        with Image.open(context.registration_path) as reg_im:
+            self.layout_width, self.layout_height = reg_im.size
+            reg_mode = reg_im.mode
+        with open(context.registration_path, 'rb') as reg_file:
+            self.registration_id = writer.add_encoded_image(reg_file.read(), self.layout_width, self.layout_height, reg_mode)
+
+        self.page_width = self.layout_width * self.scale
+        self.page_height = self.layout_height * self.scale
+
+        # Cards are placed in layout pixels and scaled to points
+        self.slot_plan = get_slot_plan(context.paper_size, context.card_size, context.registration, 300, context.extend_corners)
+        self.paper_layout = load_layouts().paper_layouts[context.paper_size]
+
+        self.font_id = writer.add_font('Helvetica')
+
+        # Every single-sided sheet shares one back page content stream
+        self.single_sided_back = None
+        if not only_fronts:
+            back_image_paths = []
+            if back_card_image_path is not None:
+                back_image_paths = [None if i in skip_indices else back_card_image_path for i in range(len(self.slot_plan.front_slots))]
+
+            self.single_sided_back = self._add_back_content(back_image_paths, (0, 0))
+
+    def _get_card_image(self, image_path: str, crop: tuple[float, float]) -> NativeCardImage:
+        image_hash = self.tile_cache.image_hashes.get(image_path) or hash_file(image_path)
+        key = (image_hash, crop)
+        if key in self.card_images:
+            return self.card_images[key]
+
+        width = self.slot_plan.card_layout_size.width
+        height = self.slot_plan.card_layout_size.height
+        extend_corners = self.context.extend_corners
+
+        with Image.open(image_path) as source:
+            orientation = source.getexif().get(0x0112, 1)
+            source_format = source.format
+            source_mode = source.mode
+            image = ImageOps.exif_transpose(source)
+
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        # Crop the outer portion of a card to remove preexisting print bleed
+        crop_x_percent, crop_y_percent = crop
+        crop_x = math.floor(image.width / 2 * (crop_x_percent / 100))
+        crop_y = math.floor(image.height / 2 * (crop_y_percent / 100))
+
+        # Trim the corners by extend_corners, measured in the card layout
+        trim_x = extend_corners * (image.width - 2 * crop_x) / width
+        trim_y = extend_corners * (image.height - 2 * crop_y) / height
+        box = (crop_x + trim_x, crop_y + trim_y, image.width - crop_x - trim_x, image.height - crop_y - trim_y)
+
+        # Never embed more pixels than the requested ppi
+        target_width = (width - 2 * extend_corners) * self.context.ppi / 300
+        target_height = (height - 2 * extend_corners) * self.context.ppi / 300
+
+        if box[2] - box[0] > target_width:
+            image = image.resize((max(1, round(target_width)), max(1, round(target_height))), box=box)
+            box = (0, 0, image.width, image.height)
+            image_id = self.writer.add_image(image)
+
+        elif source_format == 'JPEG' and orientation == 1 and source_mode in ('RGB', 'L'):
+            with open(image_path, 'rb') as image_file:
+                image_id = self.writer.add_encoded_image(image_file.read(), image.width, image.height, image.mode)
+
+        else:
+            image_id = self.writer.add_image(image)
+
+        # One-pixel strips along the edges of the shown region are stretched into print bleed
+        x0, y0, x1, y1 = box
+        left, top = math.floor(x0), math.floor(y0)
+        right, bottom = max(left + 1, math.ceil(x1)), max(top + 1, math.ceil(y1))
+
+        rgb_image = image.convert('RGB')
+        card_image = NativeCardImage(
+            image_id=image_id,
+            width=image.width,
+            height=image.height,
+            box=box,
+            left_strip_id=self.writer.add_lossless_image(image.crop((left, top, left + 1, bottom)), interpolate=False),
+            right_strip_id=self.writer.add_lossless_image(image.crop((right - 1, top, right, bottom)), interpolate=False),
+            top_strip_id=self.writer.add_lossless_image(image.crop((left, top, right, top + 1)), interpolate=False),
+            bottom_strip_id=self.writer.add_lossless_image(image.crop((left, bottom - 1, right, bottom)), interpolate=False),
+            corner_colors=[
+                rgb_image.getpixel((left, top)),
+                rgb_image.getpixel((right - 1, top)),
+                rgb_image.getpixel((left, bottom - 1)),
+                rgb_image.getpixel((right - 1, bottom - 1))
+            ]
+        )
+
+        self.card_images[key] = card_image
+        return card_image
+
+    def _card_operators(self, card_image: NativeCardImage, slot_index: int, flip: bool, xobjects: Dict[str, int]) -> str:
+        slot = (self.slot_plan.back_slots if flip else self.slot_plan.front_slots)[slot_index]
+
+        # The card rectangle in layout pixels, measured from the top left of the page
+        x, y = slot.x, slot.y
+        width, height = self.slot_plan.card_size
+        left_bleed, top_bleed, right_bleed, bottom_bleed = (side * self.scale for side in slot.bleed)
+
+        # Convert to points, measured from the bottom left of the page
+        rect_x = x * self.scale
+        rect_y = (self.layout_height - y - height) * self.scale
+        rect_width = width * self.scale
+        rect_height = height * self.scale
+
+        operators = 'q\n'
+        if flip:
+            # Rotate the back image around the center of its slot to account for orientation
+            operators += f'-1 0 0 -1 {2 * rect_x + rect_width:.4f} {2 * rect_y + rect_height:.4f} cm\n'
+            left_bleed, right_bleed = right_bleed, left_bleed
+            top_bleed, bottom_bleed = bottom_bleed, top_bleed
+
+        overlap = self.strip_overlap
+
+        # Corners are filled with the color of the corner pixels
+        top_left, top_right, bottom_left, bottom_right = card_image.corner_colors
+        for color, corner_rect in [
+            (top_left, (rect_x - left_bleed, rect_y + rect_height - overlap, left_bleed + overlap, top_bleed + overlap)),
+            (top_right, (rect_x + rect_width - overlap, rect_y + rect_height - overlap, right_bleed + overlap, top_bleed + overlap)),
+            (bottom_left, (rect_x - left_bleed, rect_y - bottom_bleed, left_bleed + overlap, bottom_bleed + overlap)),
+            (bottom_right, (rect_x + rect_width - overlap, rect_y - bottom_bleed, right_bleed + overlap, bottom_bleed + overlap))
+        ]:
+            if corner_rect[2] > overlap and corner_rect[3] > overlap:
+                red, green, blue = (channel / 255 for channel in color)
+                operators += f'{red:.4f} {green:.4f} {blue:.4f} rg {corner_rect[0]:.4f} {corner_rect[1]:.4f} {corner_rect[2]:.4f} {corner_rect[3]:.4f} re f\n'
+
+        # Edges are stretched from one-pixel strips that share the vertical or horizontal mapping of the card
+        x0, y0, x1, y1 = card_image.box
+        left, top = math.floor(x0), math.floor(y0)
+        right, bottom = max(left + 1, math.ceil(x1)), max(top + 1, math.ceil(y1))
+        vertical_box = (0, y0 - top, 1, y1 - top)
+        horizontal_box = (x0 - left, 0, x1 - left, 1)
+
+        for strip_id, strip_size, strip_box, strip_rect, strip_bleed in [
+            (card_image.left_strip_id, (1, bottom - top), vertical_box, (rect_x - left_bleed, rect_y, left_bleed + overlap, rect_height), left_bleed),
+            (card_image.right_strip_id, (1, bottom - top), vertical_box, (rect_x + rect_width - overlap, rect_y, right_bleed + overlap, rect_height), right_bleed),
+            (card_image.top_strip_id, (right - left, 1), horizontal_box, (rect_x, rect_y + rect_height - overlap, rect_width, top_bleed + overlap), top_bleed),
+            (card_image.bottom_strip_id, (right - left, 1), horizontal_box, (rect_x, rect_y - bottom_bleed, rect_width, bottom_bleed + overlap), bottom_bleed)
+        ]:
+            if strip_bleed > 0:
+                xobjects[f'Im{strip_id}'] = strip_id
+                operators += pdf_image_region(f'Im{strip_id}', strip_size, strip_box, strip_rect)
+
+        xobjects[f'Im{card_image.image_id}'] = card_image.image_id
+        operators += pdf_image_region(f'Im{card_image.image_id}', (card_image.width, card_image.height), card_image.box, (rect_x, rect_y, rect_width, rect_height))
+
+        return operators + 'Q\n'
+
+    def _layout_operators(self, card_image_paths: List[str | None], crop: tuple[float, float], flip: bool, xobjects: Dict[str, int]) -> str:
+        xobjects['Reg'] = self.registration_id
+        operators = f'q {self.page_width:.4f} 0 0 {self.page_height:.4f} 0 0 cm /Reg Do Q\n'
+
+        for i, card_image_path in enumerate(card_image_paths):
+            if card_image_path is not None:
+                with trace_span('card', image=os.path.basename(card_image_path)):
+                    operators += self._card_operators(self._get_card_image(card_image_path, crop), i, flip, xobjects)
+
+        return operators
+
+    def _add_back_content(self, card_image_paths: List[str | None], crop: tuple[float, float]) -> tuple[int, Dict[str, int]]:
+        xobjects: Dict[str, int] = {}
+        operators = self._layout_operators(card_image_paths, crop, True, xobjects)
+
+        back_offset = self.context.back_offset
+        if back_offset is not None:
+            operators = f'q 1 0 0 1 {back_offset.x_offset * self.scale:.4f} {-back_offset.y_offset * self.scale:.4f} cm\n{operators}Q\n'
+
+        return self.writer.add_content(operators.encode()), xobjects
+
+    def write_sheet(self, sheet: SheetSpec):
+        card_image_paths = [None if file is None else os.path.join(self.context.front_dir_path, file) for file in sheet.front_files]
+
+        xobjects: Dict[str, int] = {}
+        operators = self._layout_operators(card_image_paths, self.context.crop, False, xobjects)
+        label = make_sheet_label(sheet.sheet_number, self.paper_layout.width, self.paper_layout.height, 1, self.paper_layout.card_layouts[self.context.card_size].template, self.context.name)
+        operators += pdf_label_operators(label, self.layout_height, self.scale)
+
+        self.writer.add_page_object(self.writer.add_content(operators.encode()), self.page_width, self.page_height, xobjects, {'F1': self.font_id})
+
+        # Add a back page for every front page template
+        if sheet.back_files is not None:
+            back_image_paths = [None if file is None else os.path.join(self.context.double_sided_dir_path, file) for file in sheet.back_files]
+            content_id, back_xobjects = self._add_back_content(back_image_paths, self.context.crop)
+            self.writer.add_page_object(content_id, self.page_width, self.page_height, back_xobjects)
+
+        elif self.single_sided_back is not None:
+            content_id, back_xobjects = self.single_sided_back
+            self.writer.add_page_object(content_id, self.page_width, self.page_height, back_xobjects)
 
 def generate_pdf(
     front_dir_path: str,
@@ -312,7 +2156,24 @@ def generate_pdf(
     skip_indices: List[int],
     load_offset: bool,
     offset_profile: str,
-    name: str
+    name: str,
+    jobs: int = 1,
+    cache_dir: str | None = None,
+    cache_size: int = 2048,
+    native_pdf: bool = False,
+    copies: int = 1,
+    preview: bool = False,
+    preview_ppi: int = 72,
+    preview_path: str | None = None,
+    resample_quality: ResampleQuality = ResampleQuality.HIGH,
+    plan: bool = False,
+    image_format: ImageFormat = ImageFormat.PNG,
+    compress_level: int = 6,
+    codec: PageCodec = PageCodec.JPEG,
+    subsampling: Subsampling = Subsampling.S444,
+    max_sheet_mb: float | None = None,
+    memory_mb: int | None = None,
+    band_height: int | None = None
 ):
     # Sanity checks for the different directories
     f_path = Path(front_dir_path)
@@ -334,11 +2195,49 @@ def generate_pdf(
 
     # Sanity check for output images
     if output_images:
+        if native_pdf:
+            raise Exception('Cannot use "--native_pdf" with "--output_images".')
+
         output_path = get_directory(output_path)
     else:
         if not output_path.lower().endswith(".pdf"):
             raise Exception(f'Cannot save PDF to output path "{output_path}" because it is not a valid PDF file path.')
 
+    # Sanity check for the size budget, which only applies to rendered PDF pages
+    if max_sheet_mb is not None and (output_images or native_pdf):
+        raise Exception('Cannot use "--max_sheet_mb" with "--output_images" or "--native_pdf".')
+
+    # Sanity check for bands, which are only encoded into rendered PDF pages
+    if band_height is not None and (output_images or native_pdf or preview_path is not None):
+        raise Exception('Cannot use "--band_height" with "--output_images", "--native_pdf" or "--preview_path".')
+
+    # Sanity check for previews, which would replace full-resolution images in the output directory
+    if preview and output_images:
+        raise Exception('Cannot use "--preview" with "--output_images".')
+
+    if preview_path is not None:
+        if output_images or native_pdf or preview:
+            raise Exception('Cannot use "--preview_path" with "--output_images", "--native_pdf" or "--preview".')
+
+        if not preview_path.lower().endswith(".pdf"):
+            raise Exception(f'Cannot save preview to path "{preview_path}" because it is not a valid PDF file path.')
+
+    resample_quality = ResampleQuality(resample_quality)
+    codec = PageCodec(codec)
+    subsampling = Subsampling(subsampling)
+
+    # Bands are whole JPEG blocks of 16 rows, so they are encoded like the rows of a full page
+    if band_height is not None:
+        band_height -= band_height % 16
+
+    if preview:
+        print(f'Creating a preview at {preview_ppi} PPI')
+        ppi = preview_ppi
+        resample_quality = ResampleQuality.DRAFT
+
+        # A preview never replaces the PDF for printing
+        output_path = get_preview_path(output_path)
+
     # Get the back image, if it exists
     back_card_image_path = None
     use_default_back_page = True
@@ -361,290 +2260,304 @@ def generate_pdf(
         if len(ds_set) > 0:
             raise Exception(f'Cannot use "--only_fronts" with double-sided cards. Remove cards from double-side image directory "{double_sided_dir_path}".')
 
-    with open(layouts_path, 'r') as layouts_file:
-        try:
-            layouts_data = json.load(layouts_file)
-            layouts = Layouts(**layouts_data)
+    layouts = load_layouts()
 
-        except ValidationErr as e:
-            raise Exception(f'Cannot parse layouts.json: {e}.')
+    # paper_layout represents the size of a paper and all possible card layouts
+    if paper_size not in layouts.paper_layouts:
+        raise Exception(f'Unsupported paper size "{paper_size}".')
+    paper_layout = layouts.paper_layouts[paper_size]
+
+    # card_layout_size represents the size of a card
+    if card_size not in layouts.card_sizes:
+        raise Exception(f'Unsupported card size "{card_size}". Try card sizes: {paper_layout.card_layouts.keys()}.')
+    card_layout_size = layouts.card_sizes[card_size]
 
-        # paper_layout represents the size of a paper and all possible card layouts
-        if paper_size not in layouts.paper_layouts:
-            raise Exception(f'Unsupported paper size "{paper_size}".')
-        paper_layout = layouts.paper_layouts[paper_size]
+    # card_layout represents the position of cards
+    if card_size not in paper_layout.card_layouts:
+        raise Exception(f'Unsupported card size "{card_size}" with paper size "{paper_size}". Try card sizes: {paper_layout.card_layouts.keys()}.')
+    card_layout = paper_layout.card_layouts[card_size]
 
-        # card_layout_size represents the size of a card
-        if card_size not in layouts.card_sizes:
-            raise Exception(f'Unsupported card size "{card_size}". Try card sizes: {paper_layout.card_layouts.keys()}.')
-        card_layout_size = layouts.card_sizes[card_size]
+    # Determine the amount of x and y crop
+    crop = parse_crop_string(crop_string, card_layout_size.width, card_layout_size.height)
 
-        # card_layout represents the position of cards
-        if card_size not in paper_layout.card_layouts:
-            raise Exception(f'Unsupported card size "{card_size}" with paper size "{paper_size}". Try card sizes: {paper_layout.card_layouts.keys()}.')
-        card_layout = paper_layout.card_layouts[card_size]
+    num_rows = len(card_layout.y_pos)
+    num_cols = len(card_layout.x_pos)
+    num_cards = num_rows * num_cols
 
-        # Determine the amount of x and y crop
-        crop = parse_crop_string(crop_string, card_layout_size.width, card_layout_size.height)
+    # Check skip indices
+    # You can only skip valid indices (within the max card count per page)
+    clean_skip_indices = [n for n in skip_indices if n < num_cards]
+    ignore_skip_indices = [n for n in skip_indices if n >= num_cards]
 
-        num_rows = len(card_layout.y_pos)
-        num_cols = len(card_layout.x_pos)
-        num_cards = num_rows * num_cols
+    if len(ignore_skip_indices) > 0:
+        print(f'Ignoring skip indices that are outside range 0-{num_cards - 1}: {ignore_skip_indices}')
 
-        # Check skip indices
-        # You can only skip valid indices (within the max card count per page)
-        clean_skip_indices = [n for n in skip_indices if n < num_cards]
-        ignore_skip_indices = [n for n in skip_indices if n >= num_cards]
+    # If all possible cards are skipped, this may result in an infinite loop
+    if len(clean_skip_indices) == num_cards:
+        raise Exception(f'You cannot skip all cards per page')
 
-        if len(ignore_skip_indices) > 0:
-            print(f'Ignoring skip indices that are outside range 0-{num_cards - 1}: {ignore_skip_indices}')
+    registration_path = get_registration_path(paper_size, registration)
 
-        # If all possible cards are skipped, this may result in an infinite loop
-        if len(clean_skip_indices) == num_cards:
-            raise Exception(f'You cannot skip all cards per page')
+    # The baseline PPI is 300
+    ppi_ratio = ppi / 300
 
-        registration_filename =  f'{paper_size}_registration_{registration}.jpg'
-        registration_path = os.path.join(asset_directory, registration_filename)
+    # Resolve the offset for back pages before any page is written
+    back_offset = resolve_offset(load_offset, offset_profile)
 
-        # The baseline PPI is 300
-        ppi_ratio = ppi / 300
+    # The size budget of a sheet is shared by its front and back pages
+    max_page_bytes = None
+    if max_sheet_mb is not None:
+        max_page_bytes = math.floor(max_sheet_mb * 1024 * 1024 / (1 if only_fronts else 2))
 
-        # Load an image with the registration marks
-        with Image.open(registration_path) as reg_im:
-            reg_im = reg_im.resize([math.floor(reg_im.width * ppi_ratio), math.floor(reg_im.height * ppi_ratio)])
+    context = SheetRenderContext(
+        front_dir_path=front_dir_path,
+        double_sided_dir_path=double_sided_dir_path,
+        registration_path=registration_path,
+        paper_size=paper_size,
+        card_size=card_size,
+        registration=registration,
+        crop=crop,
+        ppi=ppi,
+        extend_corners=extend_corners,
+        back_offset=back_offset,
+        name=name,
+        slot_plan=get_slot_plan(paper_size, card_size, registration, ppi, extend_corners),
+        resample_quality=resample_quality,
+        band_height=band_height,
+        band_encoder=None if band_height is None else PageEncoder(quality=quality, codec=codec, subsampling=subsampling),
+        max_page_bytes=None if band_height is None else max_page_bytes
+    )
 
-            # Create the array that will store the filled templates
-            pages: List[Image.Image] = []
+    with trace_span('plan sheets'):
+        sheets = plan_sheets(natsorted(list(front_set - ds_set)), natsorted(list(ds_set)), num_cards, clean_skip_indices)
+
+    if plan:
+        print_build_plan(context, sheets, None if use_default_back_page else back_card_image_path, only_fronts, native_pdf, output_images, copies)
+        return
+
+    # Fingerprint every card image so identical images are only decoded and transformed once
+    all_image_paths = [back_card_image_path] * num_cards if not use_default_back_page else []
+    for sheet in sheets:
+        all_image_paths.extend(os.path.join(front_dir_path, file) for file in sheet.front_files if file is not None)
+        if sheet.back_files is not None:
+            all_image_paths.extend(os.path.join(double_sided_dir_path, file) for file in sheet.back_files if file is not None)
+
+    with trace_span('hash images', count=len(all_image_paths)):
+        image_hashes = hash_files(all_image_paths)
+    hash_counts = Counter(image_hashes[path] for path in all_image_paths)
+    reused_hashes = {image_hash for image_hash, count in hash_counts.items() if count > 1}
+
+    # Prepared tiles can be reused across runs from the cache directory
+    tile_store = None
+    if cache_dir is not None:
+        tile_store = TileStore(cache_dir, cache_size)
+
+    # Every rendering process keeps its own tiles, so they share the memory budget
+    tile_cache = CardTileCache(image_hashes, reused_hashes, tile_store, None if memory_mb is None else memory_mb / jobs)
+
+    resolution = math.floor(300 * ppi_ratio)
+
+    # Everything other than the card images that affects how a page is rendered and encoded
+    render_key = hashlib.sha256(repr((
+        build_manifest_version,
+        context.model_dump_json(exclude={'front_dir_path', 'double_sided_dir_path', 'name'}),
+        None if use_default_back_page else image_hashes[back_card_image_path],
+        clean_skip_indices,
+        quality,
+        resolution,
+        native_pdf,
+        codec,
+        subsampling,
+        max_sheet_mb
+    )).encode()).hexdigest()
+
+    # Pages showing the same images in the same slots only need to be rendered and embedded once
+    for sheet in sheets:
+        sheet.front_key = make_page_key(render_key, 'front', [None if file is None else image_hashes[os.path.join(front_dir_path, file)] for file in sheet.front_files])
+        if sheet.back_files is not None:
+            sheet.back_key = make_page_key(render_key, 'back', [None if file is None else image_hashes[os.path.join(double_sided_dir_path, file)] for file in sheet.back_files])
+    single_sided_back_key = make_page_key(render_key, 'single_sided_back', [])
+
+    # A PDF from a previous build is reused as is when nothing changed, and its unchanged pages are reused otherwise
+    build_key = hashlib.sha256(repr((
+        render_key,
+        [(sheet.sheet_number, sheet.front_key, sheet.back_key) for sheet in sheets],
+        name,
+        only_fronts,
+        copies
+    )).encode()).hexdigest()
+
+    # A preview is made from the rendered pages, so every page is rendered when one is requested
+    previous_build = None
+    if not output_images and preview_path is None:
+        previous_build = load_build_manifest(output_path)
+
+        if previous_build is not None and previous_build.build_key == build_key:
+            print(f'PDF is up to date: {output_path}')
+            return
+
+    # Reuse the encoded images of pages that have not changed since the previous build
+    cached_keys = set()
+    if previous_build is not None and not native_pdf:
+        page_keys = {single_sided_back_key} | {sheet.front_key for sheet in sheets} | {sheet.back_key for sheet in sheets}
+        cached_keys = page_keys & previous_build.pages.keys()
+
+    # A PDF is streamed to the output, so its first pages can be read while the rest are rendered. When pages of the
+    # previous build are reused, it is written next to the output instead and replaces it when complete.
+    build_path = f'{output_path}.tmp' if cached_keys else output_path
+
+    # An incomplete PDF is removed, whether no pages were generated or rendering failed
+    built = False
+    try:
+        if native_pdf:
+            # Cards are placed as individual images, so no page is ever rendered to a bitmap
+            with PdfWriter(build_path, resolution, quality, codec=codec, subsampling=subsampling) as writer:
+                native_writer = NativeSheetWriter(writer, context, tile_cache, None if use_default_back_page else back_card_image_path, clean_skip_indices, only_fronts)
 
-            max_print_bleed = calculate_max_print_bleed(card_layout.x_pos, card_layout.y_pos, card_layout_size.width, card_layout_size.height)
+                num_image = 1
+                for sheet in sheets:
+                    num_image = print_sheet_images(sheet, num_image)
+                    with trace_span('write sheet', sheet=sheet.sheet_number):
+                        native_writer.write_sheet(sheet)
 
-            # Create reusable back page for single-sided cards
-            single_sided_back_page = reg_im.copy()
-            if not use_default_back_page:
-
-                # Load the card back image
-                with Image.open(back_card_image_path) as back_im:
-                    back_im = ImageOps.exif_transpose(back_im)
-
-                    back_images = [back_im] * num_cards
-                    for s in clean_skip_indices:
-                        back_images[s] = None
-
-                    draw_card_layout(
-                        back_images,
-                        single_sided_back_page,
-                        num_rows,
-                        num_cols,
-                        card_layout.x_pos,
-                        card_layout.y_pos,
-                        card_layout_size.width,
-                        card_layout_size.height,
-                        max_print_bleed,
-                        (0, 0),
-                        ppi_ratio,
-                        extend_corners,
-                        flip=True
-                    )
-
-            # Create single-sided card layout
-            num_image = 1
-            it = iter(natsorted(list(front_set - ds_set)))
-            while True:
-                file_group = list(itertools.islice(it, num_cards - len(clean_skip_indices)))
-                if not file_group:
-                    break
+                writer.repeat_pages(copies)
 
-                # Fetch card art
-                front_card_images = []
-                file_group_iterator = iter(file_group)
-                for i in range(num_cards):
-                    if i in clean_skip_indices:
-                        front_card_images.append(None)
-                        continue
-
-                    try:
-                        file = next(file_group_iterator)
-                    except StopIteration:
-                        break
-
-                    print(f'Image {num_image}: {file}')
-                    num_image = num_image + 1
-
-                    front_image_path = os.path.join(front_dir_path, file)
-                    front_image = Image.open(front_image_path)
-                    front_image = ImageOps.exif_transpose(front_image)
-                    front_card_images.append(front_image)
-
-                single_sided_front_page = reg_im.copy()
-
-                # Create front layout for single-sided cards
-                draw_card_layout(
-                    front_card_images,
-                    single_sided_front_page,
-                    num_rows,
-                    num_cols,
-                    card_layout.x_pos,
-                    card_layout.y_pos,
-                    card_layout_size.width,
-                    card_layout_size.height,
-                    max_print_bleed,
-                    crop,
-                    ppi_ratio,
-                    extend_corners,
-                    flip=False
-                )
-
-                add_front_back_pages(
-                    single_sided_front_page,
-                    single_sided_back_page,
-                    pages,
-                    paper_layout.width,
-                    paper_layout.height,
-                    ppi_ratio,
-                    card_layout.template,
-                    only_fronts,
-                    name
-                )
-
-            # Create double-sided card layout
-            it = iter(natsorted(list(ds_set)))
-            while True:
-                file_group = list(itertools.islice(it, num_cards - len(clean_skip_indices)))
-                if not file_group:
-                    break
+        else:
+            # Load images with the registration marks, for front and back pages
+            with trace_span('registration pages'):
+                registration = load_registration(context, tile_store)
 
-                # Fetch card art
-                front_card_images = []
-                back_card_images = []
-                file_group_iterator = iter(file_group)
-                for i in range(num_cards):
-                    if i in clean_skip_indices:
-                        front_card_images.append(None)
-                        back_card_images.append(None)
-                        continue
-
-                    try:
-                        file = next(file_group_iterator)
-                    except StopIteration:
-                        break
-
-                    print(f'Image {num_image} (double-sided): {file}')
-                    num_image = num_image + 1
-
-                    front_image_path = os.path.join(front_dir_path, file)
-                    front_image = Image.open(front_image_path)
-                    front_image = ImageOps.exif_transpose(front_image)
-                    front_card_images.append(front_image)
-
-                    ds_image_path = os.path.join(double_sided_dir_path, file)
-                    ds_image = Image.open(ds_image_path)
-                    ds_image = ImageOps.exif_transpose(ds_image)
-                    back_card_images.append(ds_image)
-
-                double_sided_front_page = reg_im.copy()
-                double_sided_back_page = reg_im.copy()
-
-                # Create front layout for double-sided cards
-                draw_card_layout(
-                    front_card_images,
-                    double_sided_front_page,
-                    num_rows,
-                    num_cols,
-                    card_layout.x_pos,
-                    card_layout.y_pos,
-                    card_layout_size.width,
-                    card_layout_size.height,
-                    max_print_bleed,
-                    crop,
-                    ppi_ratio,
-                    extend_corners,
-                    flip=False
-                )
-
-                # Create back layout for double-sided cards
-                draw_card_layout(
-                    back_card_images,
-                    double_sided_back_page,
-                    num_rows,
-                    num_cols,
-                    card_layout.x_pos,
-                    card_layout.y_pos,
-                    card_layout_size.width,
-                    card_layout_size.height,
-                    max_print_bleed,
-                    crop,
-                    ppi_ratio,
-                    extend_corners,
-                    flip=True
-                )
-
-                # Add the front and back layouts
-                add_front_back_pages(
-                    double_sided_front_page,
-                    double_sided_back_page,
-                    pages,
-                    paper_layout.width,
-                    paper_layout.height,
-                    ppi_ratio,
-                    card_layout.template,
-                    False,
-                    name
-                )
-
-            if len(pages) == 0:
-                print('No pages were generated')
-                return
+            # Create reusable back page for single-sided cards
+            single_sided_back_page = None
+            if not only_fronts and single_sided_back_key not in cached_keys:
+                back_image_paths = [None] * num_cards
+                if not use_default_back_page:
+                    back_image_paths = [None if i in clean_skip_indices else back_card_image_path for i in range(num_cards)]
 
-            # Load saved offset if available
-            offset_applied = False
-            
-            # Try to load offset profile first (new system)
-            if offset_profile:
-                if offset_profile == "default":
-                    profiles = load_offset_profiles()
-                    if profiles.default_profile:
-                        profile = load_offset_profile(profiles.default_profile)
-                        if profile:
-                            print(f'Loaded default offset profile "{profiles.default_profile}": x={profile.x_offset}, y={profile.y_offset}')
-                            pages = offset_images(pages, profile.x_offset, profile.y_offset, ppi)
-                            offset_applied = True
-                        else:
-                            print(f'Default profile "{profiles.default_profile}" not found')
-                    else:
-                        print('No default offset profile set')
-                else:
-                    profile = load_offset_profile(offset_profile)
-                    if profile:
-                        print(f'Loaded offset profile "{offset_profile}": x={profile.x_offset}, y={profile.y_offset}')
-                        pages = offset_images(pages, profile.x_offset, profile.y_offset, ppi)
-                        offset_applied = True
-                    else:
-                        print(f'Offset profile "{offset_profile}" not found')
-            
-            # Fallback to legacy offset system if no profile was applied
-            elif load_offset and not offset_applied:
-                saved_offset = load_saved_offset()
+                with trace_span('single-sided back page'):
+                    single_sided_back_page = draw_page(context, registration, back_image_paths, (0, 0), True, tile_cache)
 
-                if saved_offset is None:
-                    print('Legacy offset cannot be applied')
+            # Pages are written as soon as they are composed, so only the current sheets are held in memory
+            if output_images:
+                writer = ImageDirectoryWriter(output_path, resolution, quality, image_format, compress_level, jobs)
+            else:
+                writer = PdfWriter(build_path, resolution, quality, jobs, codec, subsampling, max_page_bytes)
+
+            # The preview reduces every page by a whole factor, so it shares all decoding and composing with the full render
+            preview_factor = max(1, round(ppi / preview_ppi))
+            preview_writer = None
+            if preview_path is not None:
+                preview_writer = PdfWriter(preview_path, resolution / preview_factor, quality)
+
+            def add_page(page: Image.Image | List[EncodedImage] | None, key: str, sheet_number: int | None = None):
+                """Adds a page to the output and the preview, with a label for front pages"""
+                label = None
+                if sheet_number is not None:
+                    label = make_sheet_label(sheet_number, paper_layout.width, paper_layout.height, ppi_ratio, card_layout.template, name)
+
+                if band_height is not None:
+                    writer.add_banded_page(page, key, label)
                 else:
-                    print(f'Loaded legacy offset: x={saved_offset.x_offset}, y={saved_offset.y_offset}')
-                    pages = offset_images(pages, saved_offset.x_offset, saved_offset.y_offset, ppi)
+                    writer.add_page(page, key, label)
+
+                if preview_writer is not None:
+                    preview_page = None
+                    if page is not None:
+                        with trace_span('preview reduce'):
+                            preview_page = page.reduce(preview_factor)
+
+                    preview_label = None
+                    if sheet_number is not None:
+                        preview_label = make_sheet_label(sheet_number, paper_layout.width, paper_layout.height, ppi_ratio / preview_factor, card_layout.template, name)
+                    preview_writer.add_page(preview_page, key, preview_label)
+
+            with writer, preview_writer or contextlib.nullcontext():
+                if cached_keys:
+                    with trace_span('reuse pages', count=len(cached_keys)), open(output_path, 'rb') as previous_file:
+                        for key in cached_keys:
+                            record = previous_build.pages[key]
+                            previous_file.seek(record.offset)
+                            writer.add_page_image(key, previous_file.read(record.length), record.width, record.height, record.mode, record.image_filter)
+
+                    print(f'Reusing {len(cached_keys)} unchanged pages from the previous build')
+
+                # Images have their labels drawn in, so every front page is rendered for them
+                num_image = 1
+                for sheet, (front_page, back_page) in render_sheets(context, sheets, registration, tile_cache, jobs, reuse_fronts=not output_images, cached_keys=cached_keys):
+                    num_image = print_sheet_images(sheet, num_image)
+
+                    with trace_span('write pages', sheet=sheet.sheet_number):
+                        add_page(front_page, sheet.front_key, sheet.sheet_number)
+
+                        # Add a back page for every front page template
+                        if sheet.back_files is not None:
+                            add_page(back_page, sheet.back_key)
+                        elif not only_fronts:
+                            add_page(single_sided_back_page, single_sided_back_key)
+
+                writer.repeat_pages(copies)
+                if preview_writer is not None:
+                    preview_writer.repeat_pages(copies)
+
+        if tile_store is not None:
+            with trace_span('evict tiles'):
+                tile_store.evict()
+
+        if writer.page_count == 0:
+            print('No pages were generated')
+            return
+
+        if output_images:
+            print(f'Generated images: {output_path}')
+        else:
+            if build_path != output_path:
+                os.replace(build_path, output_path)
+            built = True
+            save_build_manifest(output_path, build_key, writer.page_image_records())
 
-            # Save the pages array as a PDF
-            if output_images:
-                for index, page in enumerate(pages):
-                    page.save(os.path.join(output_path, f'page{index + 1}.png'), resolution=math.floor(300 * ppi_ratio), speed=0, subsampling=0, quality=quality)
+            print(f'Generated PDF: {output_path}')
 
-                print(f'Generated images: {output_path}')
+            if preview_path is not None:
+                print(f'Generated preview: {preview_path}')
 
+    finally:
+        if not output_images and not built and os.path.exists(build_path):
+            os.remove(build_path)
+
+def resolve_offset(load_offset: bool, offset_profile: str | None) -> 'OffsetData | None':
+    """Resolve the back page offset from a named profile or the legacy saved offset"""
+    # Try to load offset profile first (new system)
+    if offset_profile:
+        if offset_profile == "default":
+            profiles = load_offset_profiles()
+            if profiles.default_profile:
+                profile = profiles.profiles.get(profiles.default_profile)
+                if profile:
+                    print(f'Loaded default offset profile "{profiles.default_profile}": x={profile.x_offset}, y={profile.y_offset}')
+                    return OffsetData(x_offset=profile.x_offset, y_offset=profile.y_offset)
+                else:
+                    print(f'Default profile "{profiles.default_profile}" not found')
             else:
-                pages[0].save(output_path, format='PDF', save_all=True, append_images=pages[1:], resolution=math.floor(300 * ppi_ratio), speed=0, subsampling=0, quality=quality)
-                print(f'Generated PDF: {output_path}')
+                print('No default offset profile set')
+        else:
+            profile = load_offset_profile(offset_profile)
+            if profile:
+                print(f'Loaded offset profile "{offset_profile}": x={profile.x_offset}, y={profile.y_offset}')
+                return OffsetData(x_offset=profile.x_offset, y_offset=profile.y_offset)
+            else:
+                print(f'Offset profile "{offset_profile}" not found')
 
-class OffsetData(BaseModel):
-    x_offset: int
-    y_offset: int
+    # Fallback to legacy offset system if no profile was requested
+    elif load_offset:
+        saved_offset = load_saved_offset()
+
+        if saved_offset is None:
+            print('Legacy offset cannot be applied')
+        else:
+            print(f'Loaded legacy offset: x={saved_offset.x_offset}, y={saved_offset.y_offset}')
+            return saved_offset
+
+    return None
 
 class OffsetProfile(BaseModel):
     name: str
@@ -658,25 +2571,162 @@ class OffsetProfiles(BaseModel):
     profiles: Dict[str, OffsetProfile] = {}
     default_profile: str = ""
 
+offset_data_path = os.path.join('data', 'offset_data.json')
+offset_profiles_path = os.path.join('data', 'offset_profiles.json')
+
+def read_umask() -> int:
+    """
+    Reads the umask of the process. Linux reports it without changing it, while other systems can only read it
+    by setting it, which is done once at import before any threads create files.
+    """
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# The mode of files created by open, which temporary files do not follow
+new_file_mode = 0o666 & ~read_umask()
+
+def write_file_atomically(path: str, text: str):
+    """Writes to a temporary file first and replaces the file, so concurrent runs never read a partial file"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+
+    # Temporary files are only readable by their owner, so the file keeps its mode, or gets the mode of new files
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = new_file_mode
+
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as temp_file:
+        try:
+            temp_file.write(text)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+            os.chmod(temp_file.name, mode)
+        except BaseException:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+
+    os.replace(temp_file.name, path)
+
+@contextlib.contextmanager
+def lock_file(path: str):
+    """Holds an exclusive lock on the file at the path, waiting for other processes to release it"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    with open(path, 'a+b') as lock:
+        if os.name == 'nt':
+            import msvcrt
+
+            # Windows gives up on a lock after about ten seconds, so keep waiting for it
+            lock.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+
+            try:
+                yield
+            finally:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+        else:
+            import fcntl
+
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+class OffsetProfileStore:
+    """
+    Offset profiles saved in a JSON file that several processes can use at once.
+    Changes are made while holding a lock file and saved by replacing the file, and profiles are only read again
+    when the file changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+
+        self._profiles: OffsetProfiles | None = None
+        self._file_id: tuple | None = None
+
+    def _read(self) -> OffsetProfiles:
+        """Reads the profiles, or the cached profiles if the file has not changed since they were read"""
+        try:
+            with open(self.path, 'r') as profiles_file:
+                # Replacing the file changes its inode, even if the size and modification time are the same
+                stat = os.fstat(profiles_file.fileno())
+                file_id = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                if self._profiles is not None and file_id == self._file_id:
+                    return self._profiles
+
+                profiles = OffsetProfiles(**json.load(profiles_file))
+
+        except FileNotFoundError:
+            profiles, file_id = OffsetProfiles(), None
+
+        self._profiles, self._file_id = profiles, file_id
+        return profiles
+
+    def _try_read(self) -> OffsetProfiles | None:
+        try:
+            return self._read()
+        except json.JSONDecodeError as e:
+            print(f'Cannot decode offset profiles JSON: {e}')
+        except (TypeError, ValueError) as e:
+            print(f'Cannot validate offset profiles data: {e}')
+
+        return None
+
+    def load(self) -> OffsetProfiles:
+        """Loads all offset profiles, which are shared with later loads and must not be changed"""
+        return self._try_read() or OffsetProfiles()
+
+    @contextlib.contextmanager
+    def edit(self) -> Iterator[OffsetProfiles | None]:
+        """
+        Yields a copy of the profiles to change while other processes wait, and saves it if it changed.
+        A file that cannot be read is never replaced, so its profiles are not lost, and None is yielded instead.
+        """
+        with lock_file(self.lock_path):
+            current = self._try_read()
+            if current is None:
+                print(f'Offset profiles in "{self.path}" are left unchanged')
+                yield None
+                return
+
+            profiles = current.model_copy(deep=True)
+            yield profiles
+
+            if profiles != current:
+                write_file_atomically(self.path, profiles.model_dump_json(indent=4))
+                self._profiles = None
+
+offset_profile_store = OffsetProfileStore(offset_profiles_path)
+
 def save_offset(x_offset, y_offset) -> None:
     """Save offset using the legacy single-profile system for backwards compatibility"""
-    # Create the directory if it doesn't exist
-    os.makedirs('data', exist_ok=True)
-
-    # Save the offset data to a JSON file
-    with open('data/offset_data.json', 'w') as offset_file:
-        offset_file.write(OffsetData(x_offset=x_offset, y_offset=y_offset).model_dump_json(indent=4))
+    write_file_atomically(offset_data_path, OffsetData(x_offset=x_offset, y_offset=y_offset).model_dump_json(indent=4))
 
     print('Offset data saved!')
 
 def save_offset_profile(name: str, x_offset: int, y_offset: int, paper_size: str = "", description: str = "") -> None:
     """Save a named offset profile"""
-    # Create the directory if it doesn't exist
-    os.makedirs('data', exist_ok=True)
-    
-    # Load existing profiles or create new structure
-    profiles = load_offset_profiles()
-    
     # Create new profile with timestamp
     from datetime import datetime
     profile = OffsetProfile(
@@ -687,47 +2737,55 @@ def save_offset_profile(name: str, x_offset: int, y_offset: int, paper_size: str
         paper_size=paper_size,
         created_at=datetime.now().isoformat()
     )
-    
-    # Add to profiles
-    profiles.profiles[name] = profile
-    
-    # Set as default if it's the first profile
-    if not profiles.default_profile:
-        profiles.default_profile = name
-    
-    # Save profiles
-    with open('data/offset_profiles.json', 'w') as profiles_file:
-        profiles_file.write(profiles.model_dump_json(indent=4))
-    
+
+    with offset_profile_store.edit() as profiles:
+        if profiles is None:
+            return
+
+        profiles.profiles[name] = profile
+
+        # Set as default if it's the first profile
+        if not profiles.default_profile:
+            profiles.default_profile = name
+
     print(f'Offset profile "{name}" saved!')
 
+def import_offset_profiles(imported: OffsetProfiles) -> tuple[int, int] | None:
+    """
+    Save many offset profiles at once, replacing profiles with the same names, and return the number added and replaced.
+    Returns None if the saved profiles cannot be read.
+    """
+    with offset_profile_store.edit() as profiles:
+        if profiles is None:
+            return None
+
+        num_replaced = sum(1 for name in imported.profiles if name in profiles.profiles)
+
+        # Profiles are keyed by their names, which imported files may not match
+        for name, profile in imported.profiles.items():
+            profiles.profiles[name] = profile.model_copy(update={'name': name})
+
+        # Keep the current default, and otherwise use the imported default
+        if not profiles.default_profile or profiles.default_profile not in profiles.profiles:
+            if imported.default_profile in profiles.profiles:
+                profiles.default_profile = imported.default_profile
+            elif profiles.profiles:
+                profiles.default_profile = next(iter(profiles.profiles))
+
+    return len(imported.profiles) - num_replaced, num_replaced
+
 def load_offset_profiles() -> OffsetProfiles:
     """Load all offset profiles"""
-    if os.path.exists('data/offset_profiles.json'):
-        with open('data/offset_profiles.json', 'r') as profiles_file:
-            try:
-                data = json.load(profiles_file)
-                return OffsetProfiles(**data)
-            except json.JSONDecodeError as e:
-                print(f'Cannot decode offset profiles JSON: {e}')
-            except ValidationErr as e:
-                print(f'Cannot validate offset profiles data: {e}')
-    
-    return OffsetProfiles()
+    return offset_profile_store.load()
 
 def load_offset_profile(profile_name: str) -> OffsetProfile:
     """Load a specific offset profile by name"""
-    profiles = load_offset_profiles()
-    
-    if profile_name in profiles.profiles:
-        return profiles.profiles[profile_name]
-    
-    return None
+    return load_offset_profiles().profiles.get(profile_name)
 
 def load_saved_offset() -> OffsetData:
     """Load offset using the legacy single-profile system for backwards compatibility"""
-    if os.path.exists('data/offset_data.json'):
-        with open('data/offset_data.json', 'r') as offset_file:
+    if os.path.exists(offset_data_path):
+        with open(offset_data_path, 'r') as offset_file:
             try:
                 data = json.load(offset_file)
                 return OffsetData(**data)
@@ -747,66 +2805,64 @@ def list_offset_profiles() -> List[str]:
 
 def delete_offset_profile(profile_name: str) -> bool:
     """Delete an offset profile"""
-    profiles = load_offset_profiles()
-    
-    if profile_name in profiles.profiles:
-        del profiles.profiles[profile_name]
-        
-        # If this was the default, clear the default
-        if profiles.default_profile == profile_name:
-            profiles.default_profile = ""
-            # Set new default to the first available profile
-            if profiles.profiles:
-                profiles.default_profile = next(iter(profiles.profiles))
-        
-        # Save updated profiles
-        with open('data/offset_profiles.json', 'w') as profiles_file:
-            profiles_file.write(profiles.model_dump_json(indent=4))
-        
+    with offset_profile_store.edit() as profiles:
+        if profiles is None:
+            return False
+
+        found = profile_name in profiles.profiles
+        if found:
+            del profiles.profiles[profile_name]
+
+            # If this was the default, set the new default to the first available profile
+            if profiles.default_profile == profile_name:
+                profiles.default_profile = next(iter(profiles.profiles), "")
+
+    if found:
         print(f'Offset profile "{profile_name}" deleted!')
-        return True
-    
-    print(f'Offset profile "{profile_name}" not found!')
-    return False
+    else:
+        print(f'Offset profile "{profile_name}" not found!')
+
+    return found
 
 def set_default_offset_profile(profile_name: str) -> bool:
     """Set the default offset profile"""
-    profiles = load_offset_profiles()
-    
-    if profile_name in profiles.profiles:
-        profiles.default_profile = profile_name
-        
-        # Save updated profiles
-        with open('data/offset_profiles.json', 'w') as profiles_file:
-            profiles_file.write(profiles.model_dump_json(indent=4))
-        
+    with offset_profile_store.edit() as profiles:
+        if profiles is None:
+            return False
+
+        found = profile_name in profiles.profiles
+        if found:
+            profiles.default_profile = profile_name
+
+    if found:
         print(f'Default offset profile set to "{profile_name}"!')
-        return True
-    
-    print(f'Offset profile "{profile_name}" not found!')
-    return False
+    else:
+        print(f'Offset profile "{profile_name}" not found!')
+
+    return found
 
-def offset_images(images: List[Image.Image], x_offset: int, y_offset: int, ppi: int) -> List[Image.Image]:
-    offset_images = []
+def offset_image(image: Image.Image, x_offset: int, y_offset: int, ppi: int) -> Image.Image:
+    return ImageChops.offset(image, math.floor(x_offset * ppi / 300), math.floor(y_offset * ppi / 300))
 
+def offset_images(images: Iterable[Image.Image], x_offset: int, y_offset: int, ppi: int) -> Iterator[Image.Image]:
+    """Offsets every other image as the images are consumed, so only the current image is held in memory"""
     add_offset = False
     for image in images:
         if add_offset:
-            offset_images.append(ImageChops.offset(image, math.floor(x_offset * ppi / 300), math.floor(y_offset * ppi / 300)))
+            yield offset_image(image, x_offset, y_offset, ppi)
         else:
-            offset_images.append(image)
+            yield image
 
         add_offset = not add_offset
 
-    return offset_images
-
-def calculate_max_print_bleed(x_pos: List[int], y_pos: List[int], width: int, height: int) -> tuple[int, int]:
-    if len(x_pos) == 1 & len(y_pos) == 1:
+def calculate_max_print_bleed(x_pos: List[int], y_pos: List[int], width: int, height: int, page_width: int, page_height: int) -> tuple[int, int]:
+    if len(x_pos) == 1 and len(y_pos) == 1:
         return (0, 0)
 
-    x_border_max = 100000
+    # Without a neighboring card, the bleed on an axis is only limited by the page
+    x_border_max = page_width
     if len(x_pos) >= 2:
-        x_pos.sort()
+        x_pos = sorted(x_pos)
 
         x_pos_0 = x_pos[0]
         x_pos_1 = x_pos[1]
@@ -814,11 +2870,11 @@ def calculate_max_print_bleed(x_pos: List[int], y_pos: List[int], width: int, he
         x_border_max = math.ceil((x_pos_1 - x_pos_0 - width) / 2)
 
         if x_border_max < 0:
-            x_border_max = 100000
+            x_border_max = page_width
 
-    y_border_max = 100000
+    y_border_max = page_height
     if len(y_pos) >= 2:
-        y_pos.sort()
+        y_pos = sorted(y_pos)
 
         y_pos_0 = y_pos[0]
         y_pos_1 = y_pos[1]
@@ -826,7 +2882,7 @@ def calculate_max_print_bleed(x_pos: List[int], y_pos: List[int], width: int, he
         y_border_max = math.ceil((y_pos_1 - y_pos_0 - height) / 2)
 
         if y_border_max < 0:
-            y_border_max = 100000
+            y_border_max = page_height
 
     return (x_border_max, y_border_max)
 